@@ -0,0 +1,621 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import http.client
+import subprocess
+import threading
+import argparse
+import platform
+import shutil
+import sqlite3
+import json
+import multiprocessing
+import random
+import logging
+import tracemalloc
+import tempfile
+import time
+import sys
+import io
+import os
+import re
+
+from main import XMLParser, DB, Value, RateServer, Logger, Converter, DailyInfoClient, UserAuthorizator, iso_date, \
+    Metrics, MetricsSink, MetricsRegistry, XMLCache
+
+# Записанные ответы сервиса ЦБ
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Валюты для синтетических ответов (код, масштаб, символьный код)
+CURRENCIES = [(36, 1, 'AUD'), (944, 1, 'AZN'), (826, 1, 'GBP'), (51, 100, 'AMD'), (933, 1, 'BYN'),
+              (975, 1, 'BGN'), (986, 1, 'BRL'), (348, 100, 'HUF'), (344, 10, 'HKD'), (208, 10, 'DKK'),
+              (840, 1, 'USD'), (978, 1, 'EUR'), (356, 100, 'INR'), (398, 100, 'KZT'), (124, 1, 'CAD'),
+              (417, 100, 'KGS'), (156, 1, 'CNY'), (498, 10, 'MDL'), (578, 10, 'NOK'), (985, 1, 'PLN'),
+              (946, 1, 'RON'), (960, 1, 'XDR'), (702, 1, 'SGD'), (972, 10, 'TJS'), (949, 10, 'TRY'),
+              (934, 1, 'TMT'), (860, 10000, 'UZS'), (980, 10, 'UAH'), (203, 10, 'CZK'), (752, 10, 'SEK'),
+              (756, 1, 'CHF'), (710, 10, 'ZAR'), (410, 1000, 'KRW'), (392, 100, 'JPY')]
+
+
+# Ответ GetCursOnDateXML за дату в формате сервиса ЦБ
+def make_response(on_date, currencies=CURRENCIES):
+    return render_response(on_date, [(code, scale, char_code, 10 + code / 100 + on_date.toordinal() % 97 / 10)
+                                      for code, scale, char_code in currencies])
+
+
+# Ответ GetCursOnDateXML по строкам (код, масштаб, символьный код, курс)
+def render_response(on_date, rows):
+    items = []
+    for code, scale, char_code, rate in rows:
+        items.append('<ValuteCursOnDate><Vname>{0}</Vname><Vnom>{1}</Vnom><Vcurs>{2:.4f}</Vcurs>'
+                     '<Vcode>{3}</Vcode><VchCode>{0}</VchCode></ValuteCursOnDate>'.format(
+                        char_code, scale, rate, code))
+    return ('<?xml version="1.0" encoding="utf-8"?><soap:Envelope '
+            'xmlns:soap="http://www.w3.org/2003/05/soap-envelope" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">'
+            '<soap:Body><GetCursOnDateXMLResponse xmlns="http://web.cbr.ru/"><GetCursOnDateXMLResult>'
+            '<ValuteData OnDate="{0}" xmlns="">{1}</ValuteData>'
+            '</GetCursOnDateXMLResult></GetCursOnDateXMLResponse></soap:Body></soap:Envelope>'.format(
+                on_date.strftime('%Y%m%d'), ''.join(items)))
+
+
+def make_fixture(days):
+    start = date(2012, 1, 1)
+    # Ответы - в байтах, как их возвращает DailyInfoClient
+    return [make_response(start + timedelta(days=i)).encode('utf-8') for i in range(days)]
+
+
+# Записанный ответ ЦБ за один день
+def load_fixture(name='GetCursOnDateXML_20220715.xml'):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+# Пакет ответов за days дней подряд: курсы записанного дня с детерминированным отклонением до ±2%
+def bulk_fixture(days, start=date(2022, 7, 15)):
+    char_codes = {code: char_code for code, scale, char_code in CURRENCIES}
+    values = XMLParser(load_fixture()).get_values()
+    result = []
+    for i in range(days):
+        on_date = start + timedelta(days=i)
+        result.append((on_date, render_response(on_date, [
+            (j.code, j.scale, char_codes.get(j.code, str(j.code)), j.rate * (1 + ((i * j.code) % 41 - 20) / 1000))
+            for j in values])))
+    return result
+
+
+def measure(func, fixture):
+    # Прогрев: разовые выделения памяти (логгер, метрики, кэши модулей) в замер не попадают
+    func(XMLParser(fixture[0]))
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = 0
+    for xml_file in fixture:
+        rows += len(func(XMLParser(xml_file)))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return rows, elapsed, peak
+
+
+# Сравнение потокового разбора с разбором через xmltodict
+def bench_parser(days=1000):
+    fixture = make_fixture(days)
+    for name, func in (('xmltodict', XMLParser.get_values_xmltodict), ('stream', XMLParser.get_values)):
+        rows, elapsed, peak = measure(func, fixture)
+        sys.stdout.write('{0:<10} {1} дней, {2} курсов: {3:.3f} с, {4:.0f} курсов/с, пик памяти {5:.1f} КБ\n'.format(
+            name, days, rows, elapsed, rows / elapsed, peak / 1024))
+
+
+# Временная БД, чтобы не трогать main.db
+def temp_db():
+    os.chdir(tempfile.mkdtemp())
+    db = DB()
+    db.create()
+    return db
+
+
+def insert_row_by_row(db, order_no, date_str, values):
+    db.cursor.execute('BEGIN TRANSACTION;')
+    for i in values:
+        db.cursor.execute('''INSERT INTO CURRENCY_COURSES (order_no, currency_no_1, currency_no_2, 
+        currency_date, scale, amount, created, created_by, branch_id) 
+        VALUES ({0}, '{1}', '{2}', '{3}', {4}, {5}, '{6}', '{7}', '{8}')
+        '''.format(order_no, i.code, '810', date_str, i.scale, i.rate, '', 'bench', 'HLN'))
+    db.cursor.execute('END;')
+    db.sql.commit()
+
+
+def insert_executemany(db, order_no, date_str, values):
+    with db.sql:
+        db.insert_courses(order_no, date_str, values, '', 'bench', 'HLN')
+
+
+def select_by_code(db, order_no, date_str, codes):
+    result = []
+    for i in codes:
+        result.append(db.cursor.execute('''SELECT * FROM CURRENCY_COURSES 
+        WHERE order_no = {0} AND currency_no_1 = '{1}';'''.format(order_no, i)).fetchone())
+    return result
+
+
+def select_in(db, order_no, date_str, codes):
+    return db.select_courses(order_no, date_str, codes)
+
+
+# Запись и чтение курсов: построчно против executemany / IN (...)
+def bench_insert(days=365):
+    fixture = [(i.strftime('%d.%m.%Y'), XMLParser(make_response(i)).get_values())
+               for i in (date(2012, 1, 1) + timedelta(days=j) for j in range(days))]
+    codes = [i[0] for i in CURRENCIES]
+    for name, insert, select in (('row', insert_row_by_row, select_by_code),
+                                 ('batch', insert_executemany, select_in)):
+        db = temp_db()
+        rows = 0
+        start = time.perf_counter()
+        for order_no, (date_str, values) in enumerate(fixture, 1):
+            db.cursor.execute("INSERT INTO CURRENCY_ORDER (order_no, created_by) VALUES (?, 'bench');", (order_no,))
+            db.sql.commit()
+            insert(db, order_no, date_str, values)
+            rows += len(values)
+        elapsed_insert = time.perf_counter() - start
+        start = time.perf_counter()
+        for order_no, (date_str, values) in enumerate(fixture, 1):
+            select(db, order_no, date_str, codes)
+        elapsed_select = time.perf_counter() - start
+        db.close()
+        sys.stdout.write('{0:<10} запись {1} строк: {2:.0f} строк/с, чтение: {3:.0f} строк/с\n'.format(
+            name, rows, rows / elapsed_insert, rows / elapsed_select))
+
+
+# Синтетический архив за years лет
+def make_archive(db, years=10):
+    start = date(2012, 1, 1)
+    with db.sql:
+        for order_no in range(1, years * 365 + 1):
+            day = start + timedelta(days=order_no - 1)
+            db.cursor.execute("INSERT INTO CURRENCY_ORDER (order_no, created_by) VALUES (?, 'bench');", (order_no,))
+            db.insert_courses(order_no, day.strftime('%d.%m.%Y'),
+                              [Value(code, scale, 10 + code / 100 + order_no % 97 / 10)
+                               for code, scale, char_code in CURRENCIES], '', 'bench', 'HLN')
+
+
+# Запросы архива без индексов и с индексами на синтетическом архиве за 10 лет
+def bench_schema(years=10, repeat=200):
+    db = temp_db()
+    make_archive(db, years)
+    day = date(2012, 1, 1) + timedelta(days=years * 365 // 2)
+    date_str = day.strftime('%d.%m.%Y')
+    order_no = years * 365 // 2 + 1
+    queries = [
+        ('order', lambda: db.cursor.execute('SELECT order_no FROM CURRENCY_COURSES WHERE currency_date = ?;',
+                                            (date_str,)).fetchone()),
+        ('codes', lambda: db.select_courses(order_no, date_str, [840, 978, 392])),
+        ('range', lambda: db.select_range(day, day + timedelta(days=365), [840])),
+    ]
+    plans = [
+        ('SELECT order_no FROM CURRENCY_COURSES WHERE currency_date = ?', (date_str,)),
+        ('SELECT * FROM CURRENCY_COURSES WHERE order_no = ? AND currency_date = ? AND currency_no_1 IN (?, ?)',
+         (order_no, date_str, '840', '978')),
+        ('SELECT * FROM CURRENCY_COURSES WHERE currency_date_iso BETWEEN ? AND ? AND currency_no_1 IN (?)',
+         (iso_date(date_str), iso_date(date_str), '840')),
+    ]
+    for name in ('idx_courses_date_code', 'idx_courses_order', 'idx_courses_date_iso', 'idx_courses_code_date'):
+        db.cursor.execute('DROP INDEX {0};'.format(name))
+    for mode in ('без индексов', 'с индексами'):
+        if mode == 'с индексами':
+            db.migrate()
+            db.sql.commit()
+        sys.stdout.write('{0}:\n'.format(mode))
+        for query, params in plans:
+            sys.stdout.write('  {0}\n'.format('; '.join(db.explain(query, params))))
+        for name, func in queries:
+            start = time.perf_counter()
+            for i in range(repeat):
+                func()
+            elapsed = time.perf_counter() - start
+            sys.stdout.write('  {0:<6} {1:.3f} мс/запрос\n'.format(name, elapsed / repeat * 1000))
+    db.close()
+
+
+# Прежнее логгирование: у каждого объекта свой FileHandler, запись в файл - синхронно
+class LegacyLogger:
+    def __init__(self):
+        self.logger = logging.getLogger('bench_legacy')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        logger_handler = logging.FileHandler('legacy.log')
+        logger_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        for i in self.logger.handlers:
+            i.close()
+        self.logger.handlers.clear()
+        self.logger.addHandler(logger_handler)
+
+
+# Время в логгировании при загрузке всех валют: синхронный FileHandler против очереди
+def bench_logging(days=365):
+    os.chdir(tempfile.mkdtemp())
+    values = XMLParser(make_response(date(2012, 1, 1))).get_values()
+    for name, logger_class in (('sync', LegacyLogger), ('queue', Logger)):
+        start = time.perf_counter()
+        for i in range(days):
+            # Клиент, парсер, БД и пользователь - по логгеру на объект, затем по строке на курс
+            for j in range(4):
+                log = logger_class()
+            for j in values:
+                log.logger.info(j)
+        elapsed = time.perf_counter() - start
+        sys.stdout.write('{0:<10} {1} записей: {2:.3f} с, {3:.1f} мкс/запись\n'.format(
+            name, days * len(values), elapsed, elapsed / (days * len(values)) * 1e6))
+    Logger.stop()
+
+
+# Конвертация сумм: построчно (курсы к рублю на каждую строку) против матриц кросс-курсов
+def bench_convert(rows=1000000, days=30):
+    db = temp_db()
+    make_archive(db, 1)
+    dates = [(date(2012, 1, 1) + timedelta(days=i)).strftime('%d.%m.%Y') for i in range(days)]
+    codes = [i[0] for i in CURRENCIES]
+    data = [(dates[i % days], float(i % 1000), codes[i % len(codes)], codes[(i * 7) % len(codes)])
+            for i in range(rows)]
+
+    start = time.perf_counter()
+    result = []
+    for date_str, amount, code_from, code_to in data:
+        rates = {}
+        for code, scale, rate in db.cursor.execute('''SELECT currency_no_1, scale, amount FROM CURRENCY_COURSES 
+        WHERE currency_date = ? AND currency_no_1 IN (?, ?);''', (date_str, str(code_from), str(code_to))):
+            rates[int(code)] = rate / scale
+        result.append(amount * rates[code_from] / rates[code_to])
+        if len(result) == 10000:
+            break
+    elapsed_row = (time.perf_counter() - start) / len(result) * rows
+
+    start = time.perf_counter()
+    Converter(db).convert_rows(data)
+    elapsed_batch = time.perf_counter() - start
+    db.close()
+    sys.stdout.write('convert    {0} строк: построчно ~{1:.1f} с (оценка по 10000), пакетно {2:.2f} с\n'.format(
+        rows, elapsed_row, elapsed_batch))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Нагрузочный тест HTTP-сервиса: клиентов с keep-alive больше, чем обработчиков, курсы - за случайные даты
+def bench_server(clients=16, requests_per_client=250, workers=8):
+    db = temp_db()
+    db.test()
+    make_archive(db, 1)
+    server = RateServer(('127.0.0.1', 0), workers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/login', json.dumps({'login': 'u01', 'password': 'qwerty'}))
+    token = json.loads(conn.getresponse().read())['token']
+    conn.close()
+
+    def client(n):
+        latencies = []
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        for i in range(requests_per_client):
+            day = date(2012, 1, 1) + timedelta(days=(n * requests_per_client + i) % 365)
+            start = time.perf_counter()
+            conn.request('GET', '/rates?date={0}&codes=840,978'.format(day.strftime('%d.%m.%Y')),
+                         headers={'Authorization': 'Bearer ' + token})
+            response = conn.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            if response.status != 200:
+                raise RuntimeError('HTTP {0}'.format(response.status))
+        conn.close()
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = [j for i in executor.map(client, range(clients)) for j in i]
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+    db.close()
+    sys.stdout.write('server     {0} запросов, {1} клиентов: {2:.0f} запросов/с, p50 {3:.2f} мс, '
+                     'p99 {4:.2f} мс\n'.format(len(latencies), clients, len(latencies) / elapsed,
+                                               percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+
+# Поддельный сервис DailyInfo: отвечает заранее подготовленным XML за запрошенную дату
+class FakeDailyInfoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = 30
+    # Заголовки и тело - одним пакетом, без задержки Нейгла
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        on_date = re.search(r'<On_date>(\d{4})-(\d{2})-(\d{2})', body)
+        response = self.server.responses.get(date(*map(int, on_date.groups())) if on_date else None)
+        with self.server.lock:
+            self.server.hits += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if response is None:
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/soap+xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeDailyInfo(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # responses - список (дата, XML); delay - задержка ответа в секундах
+    def __init__(self, responses, delay=0.0):
+        super().__init__(('127.0.0.1', 0), FakeDailyInfoHandler)
+        self.responses = {on_date: xml_file.encode('utf-8') for on_date, xml_file in responses}
+        self.delay = delay
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:{0}/DailyInfoWebServ/DailyInfo.asmx'.format(self.server_port)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+# Один прогон загрузки по этапам. trace - замер пиковой памяти (tracemalloc замедляет этапы,
+# поэтому время и память снимаются в разных прогонах)
+def run_pipeline(url, fixture, trace=False):
+    stages = {}
+
+    def stage(name, items, func):
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if trace:
+            stages[name] = {'peak_kb': tracemalloc.get_traced_memory()[1] / 1024}
+            tracemalloc.stop()
+        else:
+            stages[name] = {'seconds': elapsed, 'items': items(result),
+                            'per_second': items(result) / elapsed if elapsed else 0.0}
+        return result
+
+    days = [(on_date.strftime('%d.%m.%Y'), on_date.strftime('%d.%m.%Y').split('.')) for on_date, xml_file in fixture]
+    count = lambda result: sum(len(i) for i in result)
+    xml_files = stage('fetch', len, lambda: [DailyInfoClient(date_list, url).get_xml() for date_str, date_list in days])
+    stage('parse_xmltodict', count, lambda: [XMLParser(i).get_values_xmltodict() for i in xml_files])
+    values = stage('parse', count, lambda: [XMLParser(i).get_values() for i in xml_files])
+    fields = [re.findall(rb'<Vnom>([^<]*)</Vnom><Vcurs>([^<]*)</Vcurs><Vcode>([^<]*)</Vcode>', i) for i in xml_files]
+    stage('values', count, lambda: [[Value(code, scale, rate) for scale, rate, code in i] for i in fields])
+    user = UserAuthorizator('a01')
+    orders = stage('store', len, lambda: [user.store_currency(date_str, day_values)
+                                          for (date_str, date_list), day_values in zip(days, values)])
+    rows = stage('readback', count, lambda: [user.db.select_to_value(user.db.select_courses(order_no, date_str))
+                                             for order_no, (date_str, date_list) in zip(orders, days)])
+
+    # Вывод курсов в консоль и лог, как в UserAuthorizator.get_currency (с дозаписью очереди лога)
+    def output():
+        stdout = io.StringIO()
+        log = Logger()
+        for day_rows in rows:
+            for i in day_rows:
+                stdout.write(str(i) + '\n')
+                log.logger.info(i)
+        Logger.stop()
+        return rows
+    stage('output', count, output)
+    user.db.close()
+    return stages
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Цена метрик: замер участка кода и запрос к БД через MetricsCursor против обычного курсора
+def bench_metrics(repeat=100000, queries=20000):
+    db = temp_db()
+    make_archive(db, 1)
+    sink = Metrics.sink
+    for name, metrics_sink in (('off', MetricsSink()), ('registry', MetricsRegistry())):
+        Metrics.set_sink(metrics_sink)
+        start = time.perf_counter()
+        for i in range(repeat):
+            with Metrics.span('bench_seconds'):
+                pass
+        elapsed = time.perf_counter() - start
+        sys.stdout.write('span       {0:<10} {1:.2f} мкс/замер\n'.format(name, elapsed / repeat * 1e6))
+    Metrics.set_sink(sink)
+    plain = sqlite3.connect('main.db')
+    query = 'SELECT * FROM CURRENCY_COURSES WHERE order_no = ? AND currency_date = ?;'
+    for name, cursor in (('sqlite3', plain.cursor()), ('metrics', db.sql.cursor())):
+        start = time.perf_counter()
+        for i in range(queries):
+            cursor.execute(query, (i % 365 + 1, (date(2012, 1, 1) + timedelta(days=i % 365)).strftime('%d.%m.%Y')))
+            cursor.fetchall()
+        elapsed = time.perf_counter() - start
+        sys.stdout.write('query      {0:<10} {1:.2f} мкс/запрос\n'.format(name, elapsed / queries * 1e6))
+    plain.close()
+    db.close()
+
+
+# Авторизатор филиала загружает все даты в своем порядке: четные - по одной дате (store_currency),
+# нечетные - пакетом (ingest_dates)
+def ingest_worker(n, path, url, dates):
+    os.chdir(path)
+    user = UserAuthorizator('a{0:02d}'.format(n))
+    dates = list(dates)
+    random.Random(n).shuffle(dates)
+    if n % 2 == 0:
+        for date_str in dates:
+            date_str, values = UserAuthorizator.fetch_values(date_str, set(), url)
+            if values is not None:
+                user.store_currency(date_str, values)
+    else:
+        user.ingest_dates(dates, (), url, 4)
+    return n
+
+
+# Нагрузочный тест загрузки: авторизаторы разных филиалов (потоки, затем процессы) одновременно
+# загружают одни и те же даты. В архиве должно остаться одно распоряжение и по одной записи на валюту за дату.
+# Последняя дата - ответ без курсов: распоряжение за нее не создается ни при одной попытке
+def bench_ingest(branches=8, days=60, delay=0.005):
+    os.chdir(tempfile.mkdtemp())
+    fixture = bulk_fixture(days)
+    empty_date = fixture[-1][0] + timedelta(days=1)
+    responses = fixture + [(empty_date, render_response(empty_date, []))]
+    dates = [on_date.strftime('%d.%m.%Y') for on_date, xml_file in responses]
+    server = FakeDailyInfo(responses, delay)
+    cache = DailyInfoClient.cache
+    result = {}
+    for mode in ('threads', 'processes'):
+        db = temp_db()
+        path = os.getcwd()
+        for n in range(branches):
+            db.cursor.execute('''INSERT INTO CURRENCY_SCOPE (division_id, branch_id, cashdepart_id) 
+            VALUES (?, ?, ?);''', ('DIV{0:02d}'.format(n), 'B{0:02d}'.format(n), n))
+            db.cursor.execute("INSERT INTO USER_AUTHORIZATOR (id, password, division_id) VALUES (?, '', ?);",
+                              ('a{0:02d}'.format(n), 'DIV{0:02d}'.format(n)))
+        db.sql.commit()
+        # Общий кэш ответов в каталоге теста (у процессов - тот же файл cache.db)
+        DailyInfoClient.cache = XMLCache()
+        server.hits = 0
+        start = time.perf_counter()
+        if mode == 'threads':
+            with ThreadPoolExecutor(max_workers=branches) as executor:
+                list(executor.map(ingest_worker, range(branches), [path] * branches, [server.url] * branches,
+                                  [dates] * branches))
+        else:
+            with multiprocessing.get_context('spawn').Pool(branches) as pool:
+                pool.starmap(ingest_worker, [(n, path, server.url, dates) for n in range(branches)])
+        elapsed = time.perf_counter() - start
+        DailyInfoClient.cache.close()
+        check = {
+            'rows': db.cursor.execute('SELECT COUNT(*) FROM CURRENCY_COURSES;').fetchone()[0],
+            'orders': db.cursor.execute('SELECT COUNT(*) FROM CURRENCY_ORDER;').fetchone()[0],
+            'duplicate_rows': db.cursor.execute('''SELECT COUNT(*) FROM (SELECT 1 FROM CURRENCY_COURSES 
+            GROUP BY currency_date, currency_no_1 HAVING COUNT(*) > 1);''').fetchone()[0],
+            'split_dates': db.cursor.execute('''SELECT COUNT(*) FROM (SELECT 1 FROM CURRENCY_COURSES 
+            GROUP BY currency_date HAVING COUNT(DISTINCT order_no) > 1);''').fetchone()[0],
+            'empty_orders': db.cursor.execute('''SELECT COUNT(*) FROM CURRENCY_ORDER 
+            WHERE order_no NOT IN (SELECT order_no FROM CURRENCY_COURSES);''').fetchone()[0],
+            'fetches': server.hits,
+            'seconds': elapsed,
+        }
+        db.close()
+        result[mode] = check
+        sys.stdout.write('ingest     {0:<9} {1} филиалов, {2} дат: {3:.2f} с, строк {4}, распоряжений {5}, '
+                         'запросов к DailyInfo {6}, дубликатов {7}, дат в нескольких распоряжениях {8}, '
+                         'пустых распоряжений {9}\n'.format(mode, branches, days, elapsed, check['rows'],
+                                                             check['orders'], check['fetches'],
+                                                             check['duplicate_rows'], check['split_dates'],
+                                                             check['empty_orders']))
+        expected = days * len(XMLParser(fixture[0][1]).get_values())
+        if check['rows'] != expected or check['orders'] != days or check['duplicate_rows'] or check['split_dates'] \
+                or check['empty_orders']:
+            raise RuntimeError('Загрузка {0}: архив не согласован'.format(mode))
+    DailyInfoClient.cache = cache
+    server.close()
+    return result
+
+
+# Загрузка по этапам (запрос к поддельному DailyInfo, разбор, Value, запись, чтение, вывод)
+# на синтетическом архиве за years лет. Результат - словарь для сравнения между коммитами
+def bench_pipeline(days=250, years=10, delay=0.0):
+    # Архив строится один раз и копируется для каждого прогона
+    archive = tempfile.mkdtemp()
+    os.chdir(archive)
+    fixture = bulk_fixture(days)
+    server = FakeDailyInfo(fixture, delay)
+    cache = DailyInfoClient.cache
+    DailyInfoClient.cache = False
+    db = DB()
+    db.create()
+    db.test()
+    make_archive(db, years)
+    db.close()
+    result = []
+    for trace in (False, True):
+        os.chdir(tempfile.mkdtemp())
+        shutil.copy(os.path.join(archive, 'main.db'), 'main.db')
+        result.append(run_pipeline(server.url, fixture, trace))
+    DailyInfoClient.cache = cache
+    server.close()
+    stages = result[0]
+    for name in stages:
+        stages[name].update(result[1][name])
+        sys.stdout.write('{0:<16} {1:>8.3f} с {2:>10.0f} /с, пик памяти {3:>9.1f} КБ\n'.format(
+            name, stages[name]['seconds'], stages[name]['per_second'], stages[name]['peak_kb']))
+    total = sum(i['seconds'] for name, i in stages.items() if name != 'parse_xmltodict')
+    sys.stdout.write('{0:<16} {1:>8.3f} с, {2} дней, {3} запросов к DailyInfo\n'.format(
+        'total', total, days, server.hits))
+    return {'params': {'days': days, 'years': years, 'delay': delay, 'rows_per_day': len(XMLParser(
+        fixture[0][1]).get_values())}, 'stages': stages, 'total_seconds': total}
+
+
+# Сравнение двух отчетов --json: замедление этапа больше чем на threshold считается регрессией
+def compare(old_path, new_path, threshold=0.1):
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    regressions = 0
+    sys.stdout.write('{0} -> {1}\n'.format(old['meta'].get('revision'), new['meta'].get('revision')))
+    for bench, report in new['benchmarks'].items():
+        old_stages = old['benchmarks'].get(bench, {}).get('stages', {})
+        for name, stage in report.get('stages', {}).items():
+            if name not in old_stages:
+                continue
+            change = stage['seconds'] / old_stages[name]['seconds'] - 1
+            mark = ''
+            if change > threshold:
+                mark = '  РЕГРЕССИЯ'
+                regressions += 1
+            sys.stdout.write('{0:<10} {1:<16} {2:>8.3f} с -> {3:>8.3f} с {4:>+7.1%}{5}\n'.format(
+                bench, name, old_stages[name]['seconds'], stage['seconds'], change, mark))
+    return regressions
+
+
+BENCHMARKS = {'parser': bench_parser, 'insert': bench_insert, 'schema': bench_schema, 'server': bench_server,
+              'logging': bench_logging, 'convert': bench_convert, 'pipeline': bench_pipeline,
+              'metrics': bench_metrics, 'ingest': bench_ingest}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарки main.py')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='бенчмарки: {0} (по умолчанию - все)'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--json', metavar='PATH', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='сравнить два JSON-отчета')
+    parser.add_argument('--threshold', type=float, default=0.1, help='допустимое замедление этапа (0.1 - 10%%)')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('неизвестный бенчмарк: {0}'.format(name))
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+    output = os.path.abspath(args.json) if args.json else None
+    results = {}
+    for name in args.names or list(BENCHMARKS):
+        result = BENCHMARKS[name]()
+        if result is not None:
+            results[name] = result
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump({'meta': {'revision': git_revision(), 'time': datetime.now().isoformat(timespec='seconds'),
+                                'python': platform.python_version(), 'platform': platform.platform()},
+                       'benchmarks': results}, f, ensure_ascii=False, indent=2)
@@ -1,76 +1,593 @@
-from datetime import date
+import argparse
+from array import array
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
 import logging
+import logging.handlers
 import xmltodict
+from xml.parsers import expat
 import sqlite3
+import hashlib
+import hmac
+import json
+import math
+import csv
+import io
+import atexit
+import os
+import queue
 import re
+import secrets
 import sys
+import threading
+import time
+import zlib
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
-# Логгирование
+# Адрес сервиса DailyInfo
+DAILY_INFO_URL = 'https://www.cbr.ru/DailyInfoWebServ/DailyInfo.asmx?op=GetCursOnDateXML'
+
+
+# Запись лога в JSON (одна запись - одна строка)
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({'time': self.formatTime(record), 'name': record.name, 'level': record.levelname,
+                           'message': record.getMessage()}, ensure_ascii=False)
+
+
+# Запись в очередь без копирования записи: сообщение форматирует поток записи в файл
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Файловые обработчики не сбрасывают буфер после каждой записи, это делает LogListener
+class BufferedFlushMixin:
+    def flush(self):
+        pass
+
+    def flush_buffer(self):
+        logging.StreamHandler.flush(self)
+
+
+class BufferedRotatingFileHandler(BufferedFlushMixin, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class BufferedTimedRotatingFileHandler(BufferedFlushMixin, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+# Поток записи лога: буфер файла сбрасывается, когда очередь опустела
+class LogListener(logging.handlers.QueueListener):
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for i in self.handlers:
+                i.flush_buffer()
+            return self.queue.get(block)
+
+
+# Логгирование: один обработчик на процесс. Запрос только кладет запись в очередь,
+# в файл (UTF-8, с ротацией по размеру или по времени) ее пишет отдельный поток
 class Logger:
+    path = 'main.log'
+    json_format = False
+    max_bytes = 10 * 1024 * 1024
+    backup_count = 5
+    # Ротация по времени ('midnight', 'H', ...), None - по размеру
+    when = None
+    listener = None
+    lock = threading.Lock()
+
     def __init__(self):
         self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.INFO)
+        if Logger.listener is None:
+            Logger.configure()
+
+    @classmethod
+    def configure(cls, path=None, json_format=None, max_bytes=None, backup_count=None, when=None):
+        with cls.lock:
+            cls.path = cls.path if path is None else path
+            cls.json_format = cls.json_format if json_format is None else json_format
+            cls.max_bytes = cls.max_bytes if max_bytes is None else max_bytes
+            cls.backup_count = cls.backup_count if backup_count is None else backup_count
+            cls.when = cls.when if when is None else when
+            cls.stop_listener()
+
+            if cls.when is None:
+                handler = BufferedRotatingFileHandler(cls.path, maxBytes=cls.max_bytes,
+                                                      backupCount=cls.backup_count, encoding='utf-8')
+            else:
+                handler = BufferedTimedRotatingFileHandler(cls.path, when=cls.when,
+                                                           backupCount=cls.backup_count, encoding='utf-8')
+            if cls.json_format:
+                handler.setFormatter(JSONFormatter())
+            else:
+                handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+            log_queue = queue.SimpleQueue()
+            logger = logging.getLogger(__name__)
+            logger.setLevel(logging.INFO)
+            logger.handlers.clear()
+            logger.addHandler(LogQueueHandler(log_queue))
+            # Процесс и поток в записях не используются
+            logging.logProcesses = False
+            logging.logMultiprocessing = False
+            logging.logThreads = False
+            cls.listener = LogListener(log_queue, handler)
+            cls.listener.start()
+
+    # Дописывает очередь в файл и закрывает его
+    @classmethod
+    def stop(cls):
+        with cls.lock:
+            cls.stop_listener()
+
+    @classmethod
+    def stop_listener(cls):
+        if cls.listener is not None:
+            cls.listener.stop()
+            for i in cls.listener.handlers:
+                i.close()
+            cls.listener = None
+
+
+atexit.register(Logger.stop)
+
+
+# Гистограммы времени: границы корзин в секундах
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_HELP = {
+    'dailyinfo_request_seconds': 'Время запроса GetCursOnDateXML к DailyInfo',
+    'dailyinfo_requests_total': 'Запросы к DailyInfo по результату',
+    'dailyinfo_retries_total': 'Повторные запросы к DailyInfo',
+    'dailyinfo_cache_total': 'Обращения к кэшу ответов DailyInfo',
+    'xml_parse_seconds': 'Время разбора ответа DailyInfo',
+    'xml_values_total': 'Курсы, полученные из ответов DailyInfo',
+    'db_query_seconds': 'Время выполнения запроса к БД',
+    'db_errors_total': 'Ошибки запросов к БД',
+    'db_rows_written_total': 'Строки, записанные в БД',
+    'order_transaction_seconds': 'Время транзакции записи распоряжения и курсов',
+}
+
+
+# Приемник метрик, который ничего не делает (Metrics.set_sink(MetricsSink()) - метрики отключены)
+class MetricsSink:
+    def inc(self, name, value=1, labels=()):
+        pass
+
+    def observe(self, name, value, labels=()):
+        pass
+
+
+# Метрики в памяти процесса: счетчики и гистограммы с метками (labels - кортеж пар (имя, значение))
+class MetricsRegistry(MetricsSink):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        # (имя, метки) -> [счетчики по корзинам (последняя - +Inf), сумма, количество]
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    # Копия метрик: {'counters': {имя{метки}: значение}, 'histograms': {имя{метки}: {...}}}
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(i[0]), i[1], i[2]) for key, i in self.histograms.items()}
+        return {'counters': {self.series(name, labels): value for (name, labels), value in sorted(counters.items())},
+                'histograms': {self.series(name, labels): {'buckets': dict(zip(self.buckets + ('+Inf',), counts)),
+                                                           'sum': total, 'count': count}
+                               for (name, labels), (counts, total, count) in sorted(histograms.items())}}
+
+    @staticmethod
+    def series(name, labels=()):
+        if len(labels) == 0:
+            return name
+        return '{0}{{{1}}}'.format(name, ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')) for key, value in labels))
+
+    # Текстовый формат Prometheus (text/plain; version=0.0.4)
+    def exposition(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(i[0]), i[1], i[2])) for key, i in self.histograms.items())
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in METRICS_HELP:
+                    lines.append('# HELP {0} {1}'.format(name, METRICS_HELP[name]))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append('{0} {1}'.format(self.series(name, labels), value))
+        for (name, labels), (counts, total, count) in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, i in zip(self.buckets + ('+Inf',), counts):
+                cumulative += i
+                lines.append('{0} {1}'.format(self.series(name + '_bucket', labels + (('le', bound),)), cumulative))
+            lines.append('{0} {1}'.format(self.series(name + '_sum', labels), total))
+            lines.append('{0} {1}'.format(self.series(name + '_count', labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+# Замер времени участка кода: with Metrics.span('xml_parse_seconds'): ...
+class Span:
+    __slots__ = ('name', 'labels', 'start', 'elapsed')
+
+    def __init__(self, name, labels=()):
+        self.name = name
+        self.labels = labels
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.perf_counter() - self.start
+        Metrics.sink.observe(self.name, self.elapsed, self.labels)
+
 
-        logger_handler = logging.FileHandler('main.log')
-        logger_handler.setLevel(logging.INFO)
+# Метрики процесса: все замеры уходят в один приемник (по умолчанию - MetricsRegistry)
+class Metrics:
+    sink = MetricsRegistry()
 
-        logger_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    @classmethod
+    def set_sink(cls, sink):
+        cls.sink = sink
 
-        logger_handler.setFormatter(logger_formatter)
-        if self.logger.hasHandlers():
-            self.logger.handlers.clear()
-        self.logger.addHandler(logger_handler)
+    @classmethod
+    def inc(cls, name, value=1, labels=()):
+        cls.sink.inc(name, value, labels)
+
+    @classmethod
+    def observe(cls, name, value, labels=()):
+        cls.sink.observe(name, value, labels)
+
+    @staticmethod
+    def span(name, labels=()):
+        return Span(name, labels)
+
+    # Текстовый формат Prometheus, если приемник его поддерживает
+    @classmethod
+    def exposition(cls):
+        exposition = getattr(cls.sink, 'exposition', None)
+        return exposition() if exposition is not None else ''
+
+    # Запись в файл целиком (для textfile collector node_exporter)
+    @classmethod
+    def write(cls, path):
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(cls.exposition())
+        os.replace(path + '.tmp', path)
+
+
+# Курсор, замеряющий время каждого запроса. Метка query - команда и таблица ('INSERT CURRENCY_COURSES')
+class MetricsCursor(sqlite3.Cursor):
+    queries = {}
+
+    @classmethod
+    def labels(cls, sql):
+        labels = cls.queries.get(sql)
+        if labels is None:
+            words = sql.split(None, 1)
+            command = words[0].upper() if len(words) > 0 else ''
+            table = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE|INDEX|TRIGGER|VIEW)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)',
+                              sql, re.IGNORECASE)
+            labels = (('query', command if table is None else command + ' ' + table.group(1)),)
+            # Запросы со списком IN (?, ...) разной длины не должны раздувать кэш
+            if len(cls.queries) >= 1024:
+                cls.queries = {}
+            cls.queries[sql] = labels
+        return labels
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        except sqlite3.Error:
+            Metrics.inc('db_errors_total', 1, self.labels(sql))
+            raise
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        except sqlite3.Error:
+            Metrics.inc('db_errors_total', 1, self.labels(sql))
+            raise
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def record(self, sql, elapsed):
+        labels = self.labels(sql)
+        Metrics.observe('db_query_seconds', elapsed, labels)
+        if self.rowcount > 0 and labels[0][1].startswith(('INSERT', 'UPDATE', 'DELETE', 'REPLACE')):
+            Metrics.inc('db_rows_written_total', self.rowcount, labels)
+
+
+class MetricsConnection(sqlite3.Connection):
+    def cursor(self, factory=MetricsCursor):
+        return super().cursor(factory)
 
 
 # Валюта (код, масштаб, курс)
 class Value:
+    __slots__ = ('code', 'scale', 'rate')
+
     def __init__(self, code, scale, rate):
-        self.code = code
-        self.scale = scale
-        self.rate = rate
+        self.code = int(code)
+        self.scale = int(scale)
+        self.rate = float(rate)
 
     def __str__(self):
-        return "code " + self.code + " scale " + self.scale + " = " + self.rate
+        # Курс - с 4 знаками после запятой, как в ответе ЦБ (60.1000)
+        return "code {0} scale {1} = {2:.4f}".format(self.code, self.scale, self.rate)
         # return self.scale + " " + self.code + " = " + self.rate + " RUB"
 
 
+# Курсы за один день в колонках: коды, масштабы и курсы в параллельных массивах,
+# поиск по коду валюты - через индекс
+class DayRates:
+    __slots__ = ('on_date', 'codes', 'scales', 'rates', 'index')
+
+    def __init__(self, values=(), on_date=None):
+        self.on_date = on_date
+        self.codes = array('i')
+        self.scales = array('i')
+        self.rates = array('d')
+        self.index = {}
+        for i in values:
+            self.append(i)
+
+    def append(self, value):
+        self.index[value.code] = len(self.codes)
+        self.codes.append(value.code)
+        self.scales.append(value.scale)
+        self.rates.append(value.rate)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self.index
+
+    def __iter__(self):
+        for i in range(len(self.codes)):
+            yield Value(self.codes[i], self.scales[i], self.rates[i])
+
+    def get(self, code):
+        i = self.index.get(code)
+        if i is None:
+            return None
+        return Value(self.codes[i], self.scales[i], self.rates[i])
+
+    # Курс за одну единицу валюты
+    def unit_rate(self, code):
+        i = self.index[code]
+        return self.rates[i] / self.scales[i]
+
+
+# DD.MM.YYYY -> YYYY-MM-DD
+def iso_date(date_str):
+    return date_str[6:10] + '-' + date_str[3:5] + '-' + date_str[0:2]
+
+
+# SOAP-запрос собран заранее, подставляется только дата
+SOAP_ENVELOPE_HEAD = """
+<soap12:Envelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
+xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:soap12="http://www.w3.org/2003/05/soap-envelope">
+  <soap12:Body>
+    <GetCursOnDateXML xmlns="http://web.cbr.ru/">
+      <On_date>""".encode('utf-8')
+SOAP_ENVELOPE_TAIL = """</On_date>
+    </GetCursOnDateXML>
+  </soap12:Body>
+</soap12:Envelope>
+""".encode('utf-8')
+SOAP_HEADERS = {"Content-Type": "application/soap+xml; charset=utf-8"}
+
+
+# Кэш ответов GetCursOnDateXML: LRU в памяти поверх сжатого хранилища на диске.
+# Курсы, полученные после окончания дня, за который они запрошены, не меняются и хранятся бессрочно,
+# остальные ответы - не дольше ttl секунд
+class XMLCache:
+    def __init__(self, path='cache.db', max_size=512, ttl=300):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+        self.lock = threading.Lock()
+        self.sql = sqlite3.connect(path, check_same_thread=False)
+        self.sql.execute('''CREATE TABLE IF NOT EXISTS XML_CACHE (
+        on_date TEXT PRIMARY KEY NOT NULL,
+        fetched REAL NOT NULL,
+        xml BLOB NOT NULL);''')
+        self.sql.commit()
+
+    # Ответ бессрочен, только если получен после окончания дня, за который запрошен
+    def is_fresh(self, on_date, fetched):
+        return date.fromtimestamp(fetched) > on_date or time.time() - fetched < self.ttl
+
+    def get(self, on_date):
+        key = str(on_date)
+        with self.lock:
+            item = self.memory.get(key)
+            if item is None:
+                row = self.sql.execute('SELECT fetched, xml FROM XML_CACHE WHERE on_date = ?;', (key,)).fetchone()
+                if row is not None and self.is_fresh(on_date, row[0]):
+                    item = (row[0], zlib.decompress(row[1]))
+                    self.remember(key, item)
+                    self.stats['disk_hits'] += 1
+                    return item[1]
+            elif self.is_fresh(on_date, item[0]):
+                self.memory.move_to_end(key)
+                self.stats['hits'] += 1
+                return item[1]
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, on_date, xml):
+        key = str(on_date)
+        item = (time.time(), xml)
+        with self.lock:
+            self.remember(key, item)
+            with self.sql:
+                self.sql.execute('INSERT OR REPLACE INTO XML_CACHE (on_date, fetched, xml) VALUES (?, ?, ?);',
+                                 (key, item[0], zlib.compress(xml)))
+
+    def remember(self, key, item):
+        self.memory[key] = item
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        self.sql.close()
+
+
 # Сервис DailyInfo
 class DailyInfoClient:
-    def __init__(self, date_list):
+    # Общая сессия с пулом keep-alive соединений
+    session = None
+    # Общий кэш ответов (False - кэш отключен)
+    cache = None
+    # (connect, read) таймауты в секундах
+    timeout = (3.05, 10)
+    retries = 3
+    backoff_factor = 0.5
+    pool_size = 16
+    # Статистика запросов: количество, ошибки, суммарное время
+    stats = {'requests': 0, 'errors': 0, 'total_time': 0.0}
+    lock = threading.Lock()
+    # Блокировки по датам (фиксированный набор, дата выбирает блокировку по хэшу): одновременные запросы
+    # за одну дату ждут ответ первого из кэша
+    date_locks = [threading.Lock() for i in range(64)]
+
+    def __init__(self, date_list, url=DAILY_INFO_URL, timeout=None):
         # Логгирование
         self.log = Logger()
+        self.url = url
+        if timeout is not None:
+            self.timeout = timeout
+        self.latency = None
         self.date_currency = ''
         try:
             self.date_currency = date(int(date_list[2]), int(date_list[1]), int(date_list[0]))
         except ValueError:
             self.log.logger.warning('Неверный формат даты')
 
+    @classmethod
+    def get_session(cls):
+        with cls.lock:
+            if cls.session is None:
+                retry = Retry(total=cls.retries, backoff_factor=cls.backoff_factor,
+                              status_forcelist=(429, 500, 502, 503, 504), allowed_methods=None)
+                adapter = HTTPAdapter(pool_connections=cls.pool_size, pool_maxsize=cls.pool_size,
+                                      max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update(SOAP_HEADERS)
+                cls.session = session
+            return cls.session
+
+    @classmethod
+    def get_cache(cls):
+        with cls.lock:
+            if cls.cache is None:
+                cls.cache = XMLCache()
+            return cls.cache or None
+
     def get_xml(self):
-        url = 'https://www.cbr.ru/DailyInfoWebServ/DailyInfo.asmx?op=GetCursOnDateXML'
-        body = """
-<soap12:Envelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:soap12="http://www.w3.org/2003/05/soap-envelope">
-  <soap12:Body>
-    <GetCursOnDateXML xmlns="http://web.cbr.ru/">
-      <On_date>{0}</On_date>
-    </GetCursOnDateXML>
-  </soap12:Body>
-</soap12:Envelope>
-""".format(self.date_currency)
-        headers = {
-            "POST": "/DailyInfoWebServ/DailyInfo.asmx HTTP/1.1",
-            "Host": "www.cbr.ru",
-            "Content-Type": "application/soap+xml; charset=utf-8",
-            "Content-Length": str(len(body))
-        }
-        body = body.encode('utf-8')
-        response = requests.post(url, headers=headers, data=body)
-        if response.status_code == 200:
-            return response.text
-        else:
-            self.log.logger.warning('Подключение не удалось')
+        cache = self.get_cache() if isinstance(self.date_currency, date) else None
+        if cache is None:
+            return self.request(None)
+        with DailyInfoClient.date_locks[hash(self.date_currency) % len(DailyInfoClient.date_locks)]:
+            xml_file = cache.get(self.date_currency)
+            if xml_file is not None:
+                Metrics.inc('dailyinfo_cache_total', 1, (('result', 'hit'),))
+                return xml_file
+            Metrics.inc('dailyinfo_cache_total', 1, (('result', 'miss'),))
+            return self.request(cache)
+
+    def request(self, cache):
+        body = SOAP_ENVELOPE_HEAD + str(self.date_currency).encode('utf-8') + SOAP_ENVELOPE_TAIL
+        start = time.perf_counter()
+        try:
+            response = self.get_session().post(self.url, data=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            response = None
+            self.log.logger.warning('Подключение не удалось: {0}'.format(e))
+            # Все повторы исчерпаны
+            if len(e.args) > 0 and isinstance(e.args[0], MaxRetryError):
+                Metrics.inc('dailyinfo_retries_total', self.retries)
+        self.latency = time.perf_counter() - start
+        Metrics.observe('dailyinfo_request_seconds', self.latency)
+        if response is not None:
+            retries = getattr(response.raw, 'retries', None)
+            if retries is not None and len(retries.history) > 0:
+                Metrics.inc('dailyinfo_retries_total', len(retries.history))
+        Metrics.inc('dailyinfo_requests_total', 1, (('status', 'error' if response is None else
+                                                      str(response.status_code)),))
+        with DailyInfoClient.lock:
+            DailyInfoClient.stats['requests'] += 1
+            DailyInfoClient.stats['total_time'] += self.latency
+            if response is None or response.status_code != 200:
+                DailyInfoClient.stats['errors'] += 1
+        self.log.logger.info('GetCursOnDateXML {0}: {1:.1f} мс'.format(self.date_currency, self.latency * 1000))
+        if response is not None and response.status_code == 200:
+            # В кэш - только ответ с курсами (а не, например, страница о техработах)
+            if cache is not None and XMLParser(response.content).has_values():
+                cache.put(self.date_currency, response.content)
+            return response.content
+        if response is not None:
+            self.log.logger.warning('Подключение не удалось: HTTP {0}'.format(response.status_code))
 
 
 # Парсер XML
@@ -81,10 +598,70 @@ class XMLParser:
 
     # XML -> Values List
     def get_values(self):
-        xmltodict.parse(self.file)
+        with Metrics.span('xml_parse_seconds'):
+            values = list(self.iter_values())
+        Metrics.inc('xml_values_total', len(values))
+        return values
+
+    # XML -> DayRates
+    def get_day_rates(self, on_date=None):
+        with Metrics.span('xml_parse_seconds'):
+            rates = DayRates(self.iter_values(), on_date)
+        Metrics.inc('xml_values_total', len(rates))
+        return rates
+
+    # В ответе есть хотя бы один курс (разбор - до первого курса)
+    def has_values(self):
+        try:
+            return next(self.iter_values(), None) is not None
+        except (expat.ExpatError, ValueError, TypeError):
+            return False
+
+    # Потоковый разбор: курсы выдаются по мере чтения ответа, элементы дерева не создаются.
+    # Ответ (bytes) подается парсеру expat частями без копирования
+    def iter_values(self, chunk_size=4096):
+        if self.file is None:
+            self.log.logger.warning('Пустой ответ сервиса DailyInfo')
+            return
+        data = self.file if isinstance(self.file, str) else memoryview(self.file)
+        values = []
+        fields = {}
+        text = []
+
+        def start(tag, attrs):
+            text.clear()
+
+        def end(tag):
+            if tag in ('Vcode', 'Vnom', 'Vcurs'):
+                fields[tag] = ''.join(text).strip()
+            elif tag == 'ValuteCursOnDate':
+                values.append(Value(fields.get('Vcode'), fields.get('Vnom'), fields.get('Vcurs')))
+                fields.clear()
+            text.clear()
+
+        # Элементы курса в ответе ЦБ - без префикса пространства имен
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = text.append
+        for pos in range(0, len(data), chunk_size):
+            parser.Parse(data[pos:pos + chunk_size], False)
+            yield from values
+            values.clear()
+        parser.Parse(b'', True)
+        yield from values
+
+    # Прежний разбор через xmltodict (для сравнения в bench.py)
+    def get_values_xmltodict(self):
+        if self.file is None:
+            self.log.logger.warning('Пустой ответ сервиса DailyInfo')
+            return []
         dicts = xmltodict.parse(self.file)
         list_of_dicts = dicts['soap:Envelope']['soap:Body']['GetCursOnDateXMLResponse']['GetCursOnDateXMLResult']
         list_of_dicts = list_of_dicts['ValuteData']['ValuteCursOnDate']
+        # Одна валюта в ответе приходит словарем, а не списком
+        if isinstance(list_of_dicts, dict):
+            list_of_dicts = [list_of_dicts]
         list_of_values = []
         for i in list_of_dicts:
             list_of_values.append(Value(i['Vcode'], i['Vnom'], i['Vcurs']))
@@ -92,25 +669,110 @@ class XMLParser:
         return list_of_values
 
 
+# Пул соединений с SQLite: у каждого потока одно соединение, открывается один раз.
+# WAL позволяет читать архив из многих потоков/процессов, пока один пишет
+class ConnectionPool:
+    pragmas = ('PRAGMA journal_mode = WAL',
+               'PRAGMA synchronous = NORMAL',
+               'PRAGMA cache_size = -16000',
+               'PRAGMA mmap_size = 268435456',
+               'PRAGMA temp_store = MEMORY',
+               'PRAGMA foreign_keys = 1')
+    pools = {}
+    lock = threading.Lock()
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        # Соединения, возвращенные потоками после запроса (checkin)
+        self.idle = []
+
+    # Пул для файла БД (один на процесс)
+    @classmethod
+    def get_pool(cls, path):
+        path = os.path.abspath(path)
+        with cls.lock:
+            if path not in cls.pools:
+                cls.pools[path] = ConnectionPool(path)
+            return cls.pools[path]
+
+    def connect(self):
+        sql = getattr(self.local, 'sql', None)
+        if sql is None:
+            # Сначала - простаивающее соединение, новое открываем, только если свободных нет
+            with self.lock:
+                sql = self.idle.pop() if len(self.idle) > 0 else None
+            if sql is None:
+                # IMMEDIATE: блокировку на запись берем в начале транзакции, ожидая не дольше timeout
+                sql = sqlite3.connect(self.path, timeout=self.timeout, isolation_level='IMMEDIATE',
+                                      check_same_thread=False, factory=MetricsConnection)
+                for i in self.pragmas:
+                    sql.execute(i)
+                with self.lock:
+                    self.connections.append(sql)
+            self.local.sql = sql
+        return sql
+
+    def close(self):
+        with self.lock:
+            for i in self.connections:
+                i.close()
+            self.connections = []
+            self.idle = []
+        self.local = threading.local()
+
+    # Возвращает соединение текущего потока в пул (запрос обработан): его возьмет следующий запрос
+    def checkin(self):
+        sql = getattr(self.local, 'sql', None)
+        if sql is not None:
+            self.local.sql = None
+            if sql.in_transaction:
+                sql.rollback()
+            with self.lock:
+                if sql in self.connections:
+                    self.idle.append(sql)
+
+    # Возвращает соединения текущего потока во всех пулах
+    @classmethod
+    def checkin_thread(cls):
+        with cls.lock:
+            pools = list(cls.pools.values())
+        for i in pools:
+            i.checkin()
+
+    # Закрывает соединение текущего потока
+    def release(self):
+        sql = getattr(self.local, 'sql', None)
+        if sql is not None:
+            self.local.sql = None
+            with self.lock:
+                if sql in self.connections:
+                    self.connections.remove(sql)
+            sql.close()
+
+
 # SQLite БД
 class DB:
-    def __init__(self):
+    def __init__(self, path='main.db'):
         # Логгирование
         self.log = Logger()
         try:
-            self.sql = sqlite3.connect('main.db')
+            self.pool = ConnectionPool.get_pool(path)
+            self.sql = self.pool.connect()
             self.cursor = self.sql.cursor()
         except sqlite3.Error:
             self.log.logger.error('Ошибка при подключении к БД')
 
+    # Закрывает курсор и все соединения пула этой БД
     def close(self):
         self.cursor.close()
-        self.sql.close()
+        self.pool.close()
 
     # Создаем БД
     def create(self):
         # Таблица подразделений
-        self.cursor.execute("PRAGMA foreign_keys = 1")
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS CURRENCY_SCOPE (
         division_id TEXT PRIMARY KEY ON CONFLICT IGNORE NOT NULL,
         branch_id TEXT NOT NULL,
@@ -156,77 +818,257 @@ class DB:
         updated TEXT DEFAULT NULL,
         updated_by TEXT DEFAULT NULL,
         remarks TEXT DEFAULT ('Официальный курс ЦБ РФ'),
+        currency_date_iso TEXT DEFAULT NULL,
         FOREIGN KEY (order_no) REFERENCES CURRENCY_ORDER (order_no) ON DELETE CASCADE
         );''')
 
-        # Триггер: при обновлении архивной записи обновляем распоряжение
-        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS update_order AFTER UPDATE on CURRENCY_COURSES
+        self.migrate()
+        self.hash_passwords()
+        self.sql.commit()
+        self.log.logger.info('БД создана')
+
+    # Миграция архива: дата в формате ISO (для выборок по диапазону) и индексы
+    def migrate(self):
+        # Вся миграция - под блокировкой на запись (фиксирует вызывающий код): процесс, ждавший блокировку,
+        # проверяет схему заново и не повторяет уже выполненные шаги
+        if not self.sql.in_transaction:
+            self.cursor.execute('BEGIN IMMEDIATE;')
+        # Триггер: при отметке об обновлении архивной записи обновляем распоряжение. Прежний триггер срабатывал
+        # на любой UPDATE, в том числе на служебные UPDATE миграции, и затирал отметку распоряжения
+        trigger = self.cursor.execute('''SELECT sql FROM sqlite_master 
+        WHERE type = 'trigger' AND name = 'update_order';''').fetchone()
+        if trigger is not None and 'UPDATE OF' not in trigger[0].upper():
+            self.cursor.execute('DROP TRIGGER update_order;')
+        self.cursor.execute('''CREATE TRIGGER IF NOT EXISTS update_order 
+        AFTER UPDATE OF updated, updated_by ON CURRENCY_COURSES
         BEGIN
            UPDATE CURRENCY_ORDER SET updated = NEW.updated, updated_by = NEW.updated_by WHERE order_no = NEW.order_no;
         END;
         ''')
-        self.sql.commit()
-        self.log.logger.info('БД создана')
+        columns = [i[1] for i in self.cursor.execute('PRAGMA table_info(CURRENCY_COURSES);').fetchall()]
+        if 'currency_date_iso' not in columns:
+            self.cursor.execute('ALTER TABLE CURRENCY_COURSES ADD COLUMN currency_date_iso TEXT DEFAULT NULL;')
+            self.log.logger.info('Добавлен столбец currency_date_iso')
+        self.cursor.execute('''UPDATE CURRENCY_COURSES 
+        SET currency_date_iso = substr(currency_date, 7, 4) || '-' || substr(currency_date, 4, 2) || '-' || 
+        substr(currency_date, 1, 2) WHERE currency_date_iso IS NULL AND currency_date IS NOT NULL;''')
+        # Курс валюты за дату - одна запись (по уникальному индексу работает INSERT ... ON CONFLICT).
+        # Он же - поиск распоряжения и курсов по дате вместо прежнего idx_courses_date.
+        # Проверка индекса, удаление дубликатов и создание индекса - в транзакции миграции
+        if self.cursor.execute('''SELECT 1 FROM sqlite_master 
+        WHERE type = 'index' AND name = 'idx_courses_date_code';''').fetchone() is None:
+            self.dedupe_courses()
+            self.cursor.execute('DROP INDEX IF EXISTS idx_courses_date;')
+        # Курсы распоряжения
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS idx_courses_order 
+        ON CURRENCY_COURSES (order_no, currency_date, currency_no_1);''')
+        # Выборки по диапазону дат
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS idx_courses_date_iso 
+        ON CURRENCY_COURSES (currency_date_iso, currency_no_1);''')
+        # Ряд курсов валюты за диапазон дат
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS idx_courses_code_date 
+        ON CURRENCY_COURSES (currency_no_1, currency_date_iso);''')
+
+    # Дубликаты курсов за дату (параллельная загрузка одной даты создавала несколько распоряжений):
+    # по каждой валюте остается последняя запись, затем создается уникальный индекс, все курсы даты переходят
+    # к первому распоряжению за дату, опустевшие распоряжения удаляются
+    # (вызывается из migrate под блокировкой на запись)
+    def dedupe_courses(self):
+        orders = set(i[0] for i in self.cursor.execute('SELECT DISTINCT order_no FROM CURRENCY_COURSES;'))
+        self.cursor.execute('''DELETE FROM CURRENCY_COURSES WHERE currency_date IS NOT NULL AND course_id NOT IN (
+        SELECT MAX(course_id) FROM CURRENCY_COURSES WHERE currency_date IS NOT NULL 
+        GROUP BY currency_date, currency_no_1);''')
+        removed = self.cursor.rowcount
+        self.cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_courses_date_code 
+        ON CURRENCY_COURSES (currency_date, currency_no_1);''')
+        # Даты, курсы которых записаны несколькими распоряжениями
+        split = self.cursor.execute('''SELECT currency_date, MIN(order_no) FROM CURRENCY_COURSES 
+        WHERE currency_date IS NOT NULL GROUP BY currency_date HAVING COUNT(DISTINCT order_no) > 1;''').fetchall()
+        self.cursor.executemany('''UPDATE CURRENCY_COURSES SET order_no = ? 
+        WHERE currency_date = ? AND order_no <> ?;''', [(order_no, date_str, order_no) for date_str, order_no in split])
+        moved = self.cursor.rowcount
+        empty = orders - set(i[0] for i in self.cursor.execute('SELECT DISTINCT order_no FROM CURRENCY_COURSES;'))
+        self.cursor.executemany('DELETE FROM CURRENCY_ORDER WHERE order_no = ?;', [(i,) for i in empty])
+        if removed > 0 or moved > 0:
+            self.log.logger.info('Дубликаты курсов: удалено {0}, перенесено {1}, удалено распоряжений {2}'.format(
+                removed, moved, len(empty)))
+
+    # Пароли пользователей храним только в виде хэшей
+    def hash_passwords(self):
+        for table in ('USER', 'USER_AUTHORIZATOR'):
+            users = self.cursor.execute('''SELECT id, password FROM {0} 
+            WHERE password NOT LIKE 'pbkdf2_sha256$%';'''.format(table)).fetchall()
+            self.cursor.executemany('UPDATE {0} SET password = ? WHERE id = ?;'.format(table),
+                                    [(hash_password(password), login) for login, password in users])
+            if len(users) > 0:
+                self.log.logger.info('Пароли {0} заменены хэшами: {1}'.format(table, len(users)))
+
+    # План выполнения запроса (для проверки использования индексов)
+    def explain(self, query, params=()):
+        return [i[3] for i in self.cursor.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall()]
 
     # Select DB -> Values List
     @staticmethod
     def select_to_value(select):
         result = []
         for i in range(len(select)):
-            tmp = Value(str(select[i][2]), str(select[i][5]), str(select[i][6]))
-            if tmp is not None:
-                result.append(tmp)
+            if select[i] is not None:
+                result.append(Value(select[i][2], select[i][5], select[i][6]))
         return result
 
+    # Есть ли в архиве курсы за дату. Соединение - из пула для текущего потока, поэтому метод
+    # можно вызывать из потоков загрузки
+    def has_courses(self, date_str):
+        return self.pool.connect().execute('''SELECT 1 FROM CURRENCY_COURSES WHERE currency_date = ?
+        LIMIT 1;''', (date_str,)).fetchone() is not None
+
+    # Запись курсов за день одним executemany (транзакцию открывает вызывающий код).
+    # Курс, уже записанный за эту дату, не дублируется: обновляется, если изменился
+    def insert_courses(self, order_no, date_str, values, created, created_by, branch_id):
+        date_iso = iso_date(date_str)
+        self.cursor.executemany('''INSERT INTO CURRENCY_COURSES (order_no, currency_no_1, currency_no_2, 
+        currency_date, currency_date_iso, scale, amount, created, created_by, branch_id) 
+        VALUES (?, ?, '810', ?, ?, ?, ?, ?, ?, ?) 
+        ON CONFLICT (currency_date, currency_no_1) DO UPDATE SET scale = excluded.scale, amount = excluded.amount, 
+        updated = excluded.created, updated_by = excluded.created_by 
+        WHERE scale IS NOT excluded.scale OR amount IS NOT excluded.amount;''',
+                                [(order_no, str(i.code), date_str, date_iso, i.scale, i.rate, created, created_by,
+                                  branch_id) for i in values])
+
+    # Отметка об обновлении курсов распоряжения (всех или по кодам)
+    def touch_courses(self, order_no, date_str, updated, updated_by, codes=None):
+        if codes is None:
+            self.cursor.execute('''UPDATE CURRENCY_COURSES SET updated = ?, updated_by = ? 
+            WHERE order_no = ? AND currency_date = ?;''', (updated, updated_by, order_no, date_str))
+        elif len(codes) > 0:
+            codes = [str(i) for i in codes]
+            self.cursor.execute('''UPDATE CURRENCY_COURSES SET updated = ?, updated_by = ? 
+            WHERE order_no = ? AND currency_date = ? AND currency_no_1 IN ({0});'''.format(
+                ', '.join('?' * len(codes))), [updated, updated_by, order_no, date_str] + codes)
+
+    # Курсы распоряжения одним запросом (все или по кодам, в порядке запроса)
+    def select_courses(self, order_no, date_str, codes=None):
+        if codes is None:
+            return self.cursor.execute('''SELECT * FROM CURRENCY_COURSES 
+            WHERE order_no = ? AND currency_date = ?;''', (order_no, date_str)).fetchall()
+        codes = [str(i) for i in codes]
+        if len(codes) == 0:
+            return []
+        select = self.cursor.execute('''SELECT * FROM CURRENCY_COURSES 
+        WHERE order_no = ? AND currency_date = ? AND currency_no_1 IN ({0});'''.format(', '.join('?' * len(codes))),
+                                     [order_no, date_str] + codes).fetchall()
+        position = {}
+        for i in range(len(codes)):
+            position.setdefault(codes[i], i)
+        select.sort(key=lambda row: position[row[2]])
+        return select
+
+    # Курсы за диапазон дат (date_from, date_to - datetime.date)
+    def select_range(self, date_from, date_to, codes=None):
+        query = '''SELECT * FROM CURRENCY_COURSES WHERE currency_date_iso BETWEEN ? AND ?'''
+        params = [date_from.isoformat(), date_to.isoformat()]
+        if codes is not None:
+            query += ' AND currency_no_1 IN ({0})'.format(', '.join('?' * len(codes)))
+            params += [str(i) for i in codes]
+        return self.cursor.execute(query + ' ORDER BY currency_date_iso;', params).fetchall()
+
+    # Сравнение полученных курсов с архивом распоряжения одним запросом.
+    # Возвращает множества кодов: (новые, изменившиеся, без изменений)
+    def diff_courses(self, order_no, date_str, rates, codes=None):
+        exist = {}
+        for code, scale, amount in self.cursor.execute('''SELECT currency_no_1, scale, amount 
+        FROM CURRENCY_COURSES WHERE order_no = ? AND currency_date = ?;''', (order_no, date_str)):
+            exist[int(code)] = (scale, amount)
+        fetched = set(rates.codes)
+        if codes is not None:
+            fetched &= set(codes)
+        inserted = fetched - exist.keys()
+        updated = set()
+        unchanged = set()
+        for code in fetched & exist.keys():
+            i = rates.index[code]
+            if exist[code] == (rates.scales[i], rates.rates[i]):
+                unchanged.add(code)
+            else:
+                updated.add(code)
+        return inserted, updated, unchanged
+
     def test(self):
         self.cursor.execute('''INSERT INTO CURRENCY_SCOPE (division_id, branch_id, cashdepart_id) 
         VALUES ('KIROV1', 'HLN', 909891069)''')
         self.cursor.execute('''INSERT INTO USER_AUTHORIZATOR (id, password, division_id) 
-        VALUES ('a01', 'qwerty', 'KIROV1');''')
+        VALUES ('a01', ?, 'KIROV1');''', (hash_password('qwerty'),))
         self.cursor.execute('''INSERT INTO USER (id, password, division_id) 
-        VALUES ('u01', 'qwerty', 'KIROV1');
-        ''')
+        VALUES ('u01', ?, 'KIROV1');
+        ''', (hash_password('qwerty'),))
         self.sql.commit()
 
 
+# Хэш пароля: pbkdf2_sha256$итерации$соль$хэш
+def hash_password(password, salt=None, iterations=100000):
+    salt = secrets.token_bytes(16) if salt is None else salt
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return 'pbkdf2_sha256${0}${1}${2}'.format(iterations, salt.hex(), digest.hex())
+
+
+def check_password(password, stored):
+    try:
+        algorithm, iterations, salt, digest = stored.split('$')
+    except ValueError:
+        return False
+    if algorithm != 'pbkdf2_sha256':
+        return False
+    return hmac.compare_digest(hash_password(password, bytes.fromhex(salt), int(iterations)),
+                               'pbkdf2_sha256${0}${1}${2}'.format(iterations, salt, digest))
+
+
+# Сессия пользователя: логин, роль, подразделение и филиал определяются один раз при входе
+class Session:
+    __slots__ = ('login', 'authorizator', 'division', 'branch')
+
+    def __init__(self, login, authorizator, division, branch):
+        self.login = login
+        self.authorizator = authorizator
+        self.division = division
+        self.branch = branch
+
+
 # Класс авторизации
 class Authorization:
     def __init__(self):
         self.login = ''
         self.password = ''
+        self.session = None
         self.db = DB()
         # Логгирование
         self.log = Logger()
 
     def is_logged_in(self):
-        logged = self.db.cursor.execute('''
-        SELECT id, password FROM USER WHERE id = '{0}' AND password = '{1}' 
-        UNION SELECT id, password FROM USER_AUTHORIZATOR 
-        WHERE id = '{0}' AND password = '{1}';'''.format(self.login, self.password)).fetchone()
-        self.db.sql.commit()
-        if logged is not None:
-            self.login = logged[0]
-            self.password = logged[1]
-            self.log.logger.info('Успешная авторизация {0}'.format(self.login))
-            return True
-        else:
-            self.log.logger.info('Неудачная попытка авторизации')
-            return False
+        # Пользователь, роль, подразделение и филиал - одним запросом
+        users = self.db.cursor.execute('''
+        SELECT u.id, u.password, 0, u.division_id, s.branch_id FROM USER u 
+        LEFT JOIN CURRENCY_SCOPE s ON s.division_id = u.division_id WHERE u.id = ? 
+        UNION ALL SELECT a.id, a.password, 1, a.division_id, s.branch_id FROM USER_AUTHORIZATOR a 
+        LEFT JOIN CURRENCY_SCOPE s ON s.division_id = a.division_id WHERE a.id = ?;''',
+                                       (self.login, self.login)).fetchall()
+        # Если логин есть в обеих таблицах, приоритет у авторизатора
+        for login, password, authorizator, division, branch in sorted(users, key=lambda i: -i[2]):
+            if check_password(self.password, password):
+                self.session = Session(login, authorizator == 1, division, branch)
+                self.login = login
+                self.log.logger.info('Успешная авторизация {0}'.format(self.login))
+                return True
+        self.session = None
+        self.log.logger.info('Неудачная попытка авторизации')
+        return False
 
     def is_authorizator(self):
-        authorizators = self.db.cursor.execute('''
-        SELECT id, password FROM USER_AUTHORIZATOR 
-        WHERE id = '{0}' AND password = '{1}';'''.format(self.login, self.password)).fetchone()
-        self.db.sql.commit()
-        if authorizators is None or len(authorizators) == 0:
-            return False
-        else:
-            return True
+        return self.session is not None and self.session.authorizator
 
-    def try_logging(self):
-        sys.stdout.write('login: \n')
+    def try_logging(self, out=sys.stdout):
+        out.write('login: \n')
         self.login = sys.stdin.readline().strip()
-        sys.stdout.write('password: \n')
+        out.write('password: \n')
         self.password = sys.stdin.readline().strip()
         self.log.logger.info('Попытка входа')
 
@@ -256,248 +1098,998 @@ class ScriptRequest:
             self.log.logger.info('Неизвестная комманда')
         return result
 
+    def is_range(self):
+        return re.fullmatch(r'\d{2}\.\d{2}\.\d{4}-\d{2}\.\d{2}\.\d{4}(?: \d{3})*$', self.text) is not None
+
+    # DD.MM.YYYY-DD.MM.YYYY [codes] -> [date_from, date_to, codes]
+    def parse_range(self):
+        result = []
+        if self.is_range():
+            request = self.text.split()
+            try:
+                for i in request[0].split('-'):
+                    day, month, year = i.split('.')
+                    result.append(date(int(year), int(month), int(day)))
+            except ValueError:
+                self.log.logger.warning('Неверный формат даты')
+                return []
+            result.append([int(i) for i in request[1::]])
+        else:
+            self.log.logger.info('Неизвестная комманда')
+        return result
+
 
 # Класс пользователя
 class User:
-    def __init__(self, login):
+    def __init__(self, login, session=None):
         self.login = login
+        self.session = session
         self.db = DB()
         # Логгирование
         self.log = Logger()
 
+    # Курсы из архива за дату (по кодам, если они указаны). None - курсов в архиве нет
+    def read_currency(self, date_str, codes=None):
+        date_now = self.db.cursor.execute('''SELECT datetime('now', 'localtime')''').fetchone()[0]
+        order_no = self.db.cursor.execute(
+            '''SELECT order_no FROM CURRENCY_COURSES WHERE currency_date = ?;''', (date_str,)).fetchone()
+        if order_no is None:
+            return None
+        order_no = order_no[0]
+        # Обновляем архив (по конкретным кодам, если они указаны)
+        with self.db.sql:
+            self.db.touch_courses(order_no, date_str, date_now, self.login, codes)
+        return self.db.select_to_value(self.db.select_courses(order_no, date_str, codes))
+
     def get_currency(self, text):
         sr = ScriptRequest(text)
         req = sr.parse_command()
         date_str = sr.text.split()[0]
-        date_now = self.db.cursor.execute('''SELECT datetime('now', 'localtime')''').fetchone()[0]
-        order_no = self.db.cursor.execute(
-            '''SELECT order_no FROM CURRENCY_COURSES WHERE currency_date = '{0}';'''.format(date_str)).fetchone()
-        if order_no is None:
+        values = self.read_currency(date_str, req[1] if len(req) == 2 else None) if len(req) > 0 else None
+        if values is None:
             msg = 'Курсы валют не найдены'
             sys.stdout.write(msg)
             self.log.logger.info(msg)
         else:
-            order_no = order_no[0]
-            if len(req) == 1:
-                # Обновляем архив
-                self.db.cursor.execute('BEGIN TRANSACTION;')
-                self.db.cursor.execute('''UPDATE CURRENCY_COURSES SET 
-                                                updated = '{0}', updated_by = '{1}' WHERE order_no = {2};'''.format(
-                    date_now, self.login, order_no))
-                self.db.cursor.execute('END;')
-                self.db.sql.commit()
-                # Вывод в лог файл
-                archive = self.db.cursor.execute(
-                    '''SELECT * FROM CURRENCY_COURSES WHERE order_no = '{0}';'''.format(order_no)).fetchall()
-                for i in self.db.select_to_value(archive):
-                    self.log.logger.info(i)
-                    sys.stdout.write(str(i) + '\n')
-            elif len(req) == 2:
-                codes = req[1]
-                # Обновляем архив по конкретным кодам
-                self.db.cursor.execute('BEGIN TRANSACTION;')
-                for i in codes:
-                    self.db.cursor.execute('''
-                    UPDATE CURRENCY_COURSES SET updated = '{0}', updated_by = '{1}' 
-                    WHERE currency_no_1 = '{2}' AND order_no = {3};'''.format(date_now, self.login, i, order_no))
-                self.db.cursor.execute('END;')
-                self.db.sql.commit()
-                # Выводим в лог файл
-                results = []
-                for i in range(len(codes)):
-                    tmp = self.db.cursor.execute(
-                        '''SELECT * FROM CURRENCY_COURSES WHERE order_no = {0} AND currency_no_1 = '{1}';'''.format(
-                            order_no, codes[i])).fetchone()
-                    if tmp is not None:
-                        results.append(tmp)
-                values = self.db.select_to_value(results)
-                for i in values:
-                    sys.stdout.write(str(i) + '\n')
-                    self.log.logger.info(i)
+            # Выводим в лог файл
+            for i in values:
+                sys.stdout.write(str(i) + '\n')
+                self.log.logger.info(i)
 
 
 class UserAuthorizator(User):
 
+    # Подразделение авторизатора
+    def get_branch(self):
+        if self.session is not None:
+            return self.session.branch
+        return self.db.cursor.execute('''SELECT s.branch_id FROM USER_AUTHORIZATOR a 
+        JOIN CURRENCY_SCOPE s ON s.division_id = a.division_id WHERE a.id = ?;''', (self.login,)).fetchone()[0]
+
+    # Загрузка даты, которой еще нет в архиве (выполняется в пуле потоков). Пока дата ждала в очереди,
+    # ее мог загрузить другой авторизатор: тогда сервис не запрашивается, а курсы - пустой список.
+    # Соединение потока загрузки закрывается сразу: потоки пула завершаются вместе с загрузкой
+    def fetch_missing(self, date_str, codes, url):
+        try:
+            if self.db.has_courses(date_str):
+                return date_str, []
+        finally:
+            self.db.pool.release()
+        return self.fetch_values(date_str, codes, url)
+
+    # Загрузка одной даты для backfill (выполняется в пуле потоков)
+    @staticmethod
+    def fetch_values(date_str, codes, url):
+        xml_file = DailyInfoClient(date_str.split('.'), url).get_xml()
+        if xml_file is None:
+            return date_str, None
+        # Ответ не XML (например, страница о техработах): дата пропускается до следующего прохода
+        try:
+            values = XMLParser(xml_file).get_values()
+        except (expat.ExpatError, ValueError, TypeError) as e:
+            Logger().logger.warning('Ответ за {0} не разобран: {1}'.format(date_str, e))
+            return date_str, None
+        if len(codes) > 0:
+            values = [i for i in values if i.code in codes]
+        return date_str, values
+
+    # Загрузка архива за диапазон дат: DD.MM.YYYY-DD.MM.YYYY [codes]
+    def backfill(self, text, url=DAILY_INFO_URL, workers=8):
+        req = ScriptRequest(text).parse_range()
+        if len(req) == 0:
+            return
+        start = time.perf_counter()
+        codes = set(req[2])
+
+        # Даты, которые уже есть в архиве, не загружаем
+        dates_exist = set(i[0] for i in self.db.cursor.execute('''SELECT DISTINCT currency_date 
+        FROM CURRENCY_COURSES WHERE currency_date_iso BETWEEN ? AND ?;''',
+                                                                (req[0].isoformat(), req[1].isoformat())).fetchall())
+        dates = []
+        day = req[0]
+        while day <= req[1]:
+            if day.strftime('%d.%m.%Y') not in dates_exist:
+                dates.append(day.strftime('%d.%m.%Y'))
+            day += timedelta(days=1)
+
+        loaded = self.ingest_dates(dates, codes, url, workers)
+        elapsed = time.perf_counter() - start
+        msg = 'Загружено дат: {0} из {1} за {2:.2f} с ({3:.1f} дат/с)'.format(
+            loaded, len(dates), elapsed, loaded / elapsed if elapsed > 0 else 0)
+        sys.stdout.write(msg + '\n')
+        self.log.logger.info(msg)
+
+    # Загрузка дат (DD.MM.YYYY), которых нет в архиве: запросы к DailyInfo - в пуле потоков,
+    # ордер и курсы за день - одной транзакцией. Возвращает число загруженных дат
+    def ingest_dates(self, dates, codes=(), url=DAILY_INFO_URL, workers=8):
+        codes = set(codes)
+        branch = self.get_branch()
+        loaded = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.fetch_missing, i, codes, url): i for i in dates}
+            for future in as_completed(futures):
+                try:
+                    date_str, values = future.result()
+                except Exception as e:
+                    date_str, values = futures[future], None
+                    self.log.logger.error('Ошибка загрузки курсов за {0}: {1}'.format(date_str, e))
+                if values is None:
+                    self.log.logger.warning('Курсы валют за {0} не загружены'.format(date_str))
+                    continue
+                date_now = self.db.cursor.execute('''SELECT datetime('now', 'localtime')''').fetchone()[0]
+                with Metrics.span('order_transaction_seconds') as span, self.db.sql:
+                    # Дату мог загрузить другой авторизатор: проверяем под блокировкой на запись
+                    self.db.cursor.execute('BEGIN IMMEDIATE;')
+                    if self.db.cursor.execute('''SELECT 1 FROM CURRENCY_COURSES WHERE currency_date = ? 
+                    LIMIT 1;''', (date_str,)).fetchone() is not None:
+                        span.labels = (('result', 'exists'),)
+                        self.log.logger.info('Курсы валют за {0} уже загружены'.format(date_str))
+                        continue
+                    # В ответе нет курсов (или нет запрошенных кодов): распоряжение не создаем
+                    if len(values) == 0:
+                        span.labels = (('result', 'empty'),)
+                        self.log.logger.warning('Курсы валют за {0} не найдены'.format(date_str))
+                        continue
+                    span.labels = (('result', 'new'),)
+                    self.db.cursor.execute('''INSERT INTO CURRENCY_ORDER (created ,created_by, branch_id) 
+                    VALUES (?, ?, ?);''', (date_now, self.login, branch))
+                    order_no = self.db.cursor.lastrowid
+                    self.db.insert_courses(order_no, date_str, values, date_now, self.login, branch)
+                loaded += 1
+        return loaded
+
     def get_currency(self, text):
         sr = ScriptRequest(text)
+        if sr.is_range():
+            self.backfill(text)
+            return
         req = sr.parse_command()
-        date_str = sr.text.split()[0]
+        values = self.load_currency(req[0], req[1] if len(req) == 2 else None)
+        if values is None:
+            msg = 'Сервис DailyInfo недоступен'
+            sys.stdout.write(msg + '\n')
+            self.log.logger.warning(msg)
+            return
+        if len(values) == 0:
+            msg = 'Курсы валют не найдены'
+            sys.stdout.write(msg + '\n')
+            self.log.logger.info(msg)
+            return
 
+        # Выводим в консоль курсы валют из таблицы
+        for i in values:
+            sys.stdout.write(str(i) + '\n')
+            self.log.logger.info(i)
+
+    # Загрузка курсов за дату из DailyInfo в архив и чтение из архива. None - сервис недоступен,
+    # пустой список - курсов нет
+    def load_currency(self, date_list, codes=None):
         # Подключение к DailyInfo, парсинг XML и получение курсов
-        dic = DailyInfoClient(req[0])
+        dic = DailyInfoClient(date_list)
         xml_file = dic.get_xml()
-        parser = XMLParser(xml_file)
-        values = parser.get_values()
+        if xml_file is None:
+            return None
+        # Ответ не XML (например, страница о техработах) - как недоступный сервис
+        try:
+            values = XMLParser(xml_file).get_values()
+        except (expat.ExpatError, ValueError, TypeError) as e:
+            self.log.logger.warning('Ответ DailyInfo не разобран: {0}'.format(e))
+            return None
+        date_str = '.'.join(date_list)
+        order_no = self.store_currency(date_str, values, codes)
+        if order_no is None:
+            return []
+        return self.db.select_to_value(self.db.select_courses(order_no, date_str, codes))
+
+    # Запись полученных курсов за дату в архив (по кодам, если они указаны). Возвращает номер распоряжения
+    # (None - курсов нет, распоряжение не создано).
+    # Проверка архива и запись - одной транзакцией под блокировкой на запись: авторизатор, параллельно
+    # загружающий ту же дату, дождется ее окончания и обновит уже созданное распоряжение
+    def store_currency(self, date_str, values, codes=None):
         # Получение данных из БД (тут как-то можно использовать join?)
-        division = self.db.cursor.execute('''
-        SELECT division_id FROM USER_AUTHORIZATOR WHERE id = '{0}';'''.format(self.login)).fetchone()[0]
-        branch = self.db.cursor.execute(
-            '''SELECT branch_id FROM CURRENCY_SCOPE WHERE division_id = '{0}';'''.format(division)).fetchone()[0]
+        branch = self.get_branch()
         date_now = self.db.cursor.execute('''SELECT datetime('now', 'localtime')''').fetchone()[0]
 
-        order_no = self.db.cursor.execute(
-            '''SELECT order_no FROM CURRENCY_COURSES WHERE currency_date = '{0}';'''.format(date_str)).fetchone()
-        self.db.sql.commit()
-        if order_no is None:
-
-            # В архиве - пусто создаем ордер
-            self.db.cursor.execute('''INSERT INTO CURRENCY_ORDER (created ,created_by, branch_id) 
-            VALUES ('{0}', '{1}','{2}');'''.format(date_now, self.login, branch))
-            order_no = self.db.cursor.execute('''SELECT order_no FROM CURRENCY_ORDER 
-            WHERE created = '{0}' AND created_by = '{1}';'''.format(date_now, self.login)).fetchone()[0]
-            self.db.sql.commit()
-            if len(req) == 1:
-                self.db.cursor.execute('BEGIN TRANSACTION;')
-                # Создаем записи в архиве и выводим курсы валют
-                for i in values:
-                    self.db.cursor.execute('''INSERT INTO CURRENCY_COURSES (order_no, currency_no_1, currency_no_2, 
-                    currency_date, scale, amount, created, created_by, branch_id) 
-                    VALUES ({0}, '{1}', '{2}', '{3}', {4}, {5}, '{6}', '{7}', '{8}')
-                    '''.format(order_no, i.code, '810', date_str, i.scale, i.rate, date_now, self.login, branch))
-                self.db.cursor.execute('END;')
-                self.db.sql.commit()
-                # Выводим в лог курсы валют из таблицы
-                select = self.db.cursor.execute('''SELECT * FROM CURRENCY_COURSES 
-                WHERE order_no = '{0}';'''.format(order_no)).fetchall()
-
-                for i in self.db.select_to_value(select):
-                    sys.stdout.write(str(i) + '\n')
-                    self.log.logger.info(i)
-            elif len(req) == 2:
-                self.db.sql.commit()
-                request_values = []
+        with Metrics.span('order_transaction_seconds') as span, self.db.sql:
+            self.db.cursor.execute('BEGIN IMMEDIATE;')
+            order_no = self.db.cursor.execute(
+                '''SELECT order_no FROM CURRENCY_COURSES WHERE currency_date = ?;''', (date_str,)).fetchone()
+            if order_no is None:
                 # Получаем нужные курсы валют
-                # в req - инт в value - стр
-                for i in range(len(values)):
-                    if int(values[i].code) in req[1]:
-                        request_values.append(values[i])
-                        self.log.logger.info(values[i])
-                # Тут была вставка ордера
-                self.db.cursor.execute('BEGIN TRANSACTION;')
-                # Создаем записи в архиве и выводим курсы валют
-                for i in request_values:
-                    self.db.cursor.execute('''INSERT INTO CURRENCY_COURSES (order_no, currency_no_1, currency_no_2, 
-                                                        currency_date, scale, amount, created, created_by, branch_id) 
-                                                        VALUES ({0}, '{1}', '{2}', '{3}', {4}, {5}, '{6}', '{7}', '{8}')
-                                                        '''.format(order_no, i.code, '810', date_str, i.scale, i.rate,
-                                                                   date_now, self.login, branch))
-                self.db.cursor.execute('END;')
-                selects = []
-                # Выводим в лог курсы валют из таблицы
-                for i in range(len(req[1])):
-                    tmp = self.db.cursor.execute(
-                        '''SELECT * FROM CURRENCY_COURSES WHERE order_no = {0} AND currency_no_1 = '{1}';'''.format(
-                            order_no, req[1][i])).fetchone()
-                    selects.append(tmp)
-                values = self.db.select_to_value(selects)
-                for i in values:
-                    sys.stdout.write(str(i) + '\n')
-                    self.log.logger.info(i)
-        else:
-            # В архиве есть записи
-            order_no = order_no[0]
-            if len(req) == 1:
-                # Существующие коды
-                codes_exist = self.db.cursor.execute(
-                    '''SELECT currency_no_1 FROM CURRENCY_COURSES WHERE currency_date = '{0}';'''.format(
-                        date_str)).fetchall()
-                self.db.sql.commit()
-                # Обновляем архив
-                self.db.cursor.execute('''UPDATE CURRENCY_COURSES SET 
-                updated = '{0}', updated_by = '{1}' WHERE order_no = {2};'''.format(date_now, self.login, order_no))
-                self.db.sql.commit()
-                # Находим еще несуществующие курсы
-                codes_dont_exist = []
-                list_codes_exist = []
-                for i in range(len(codes_exist)):
-                    list_codes_exist.append(codes_exist[i][0])
-
-                for i in range(len(values)):
-                    if values[i].code not in list_codes_exist:
-                        codes_dont_exist.append(values[i])
+                if codes is not None:
+                    codes_set = set(codes)
+                    values = [i for i in values if i.code in codes_set]
+                    for i in values:
+                        self.log.logger.info(i)
+                # Курсов нет: распоряжение не создаем
+                if len(values) == 0:
+                    span.labels = (('result', 'empty'),)
+                    self.log.logger.warning('Курсы валют за {0} не найдены'.format(date_str))
+                    return None
+                span.labels = (('result', 'new'),)
+                # В архиве - пусто, создаем ордер и записи в архиве
+                self.db.cursor.execute('''INSERT INTO CURRENCY_ORDER (created ,created_by, branch_id) 
+                VALUES (?, ?, ?);''', (date_now, self.login, branch))
+                order_no = self.db.cursor.lastrowid
+                self.db.insert_courses(order_no, date_str, values, date_now, self.login, branch)
+            else:
+                span.labels = (('result', 'update'),)
+                # В архиве есть записи
+                order_no = order_no[0]
+                rates = DayRates(values)
+                inserted, updated, unchanged = self.db.diff_courses(order_no, date_str, rates, codes)
+                # Отмечаем в архиве уже существующие курсы
+                self.db.touch_courses(order_no, date_str, date_now, self.login, updated | unchanged)
+                # Изменившиеся курсы перезаписываем
+                self.db.cursor.executemany('''UPDATE CURRENCY_COURSES SET scale = ?, amount = ? 
+                WHERE order_no = ? AND currency_date = ? AND currency_no_1 = ?;''',
+                                           [(rates.get(i).scale, rates.get(i).rate, order_no, date_str, str(i))
+                                            for i in updated])
                 # Добавляем несуществующие курсы в архив
-                for i in codes_dont_exist:
-                    self.db.cursor.execute('''INSERT INTO CURRENCY_COURSES (order_no, currency_no_1, currency_no_2, 
-                                                    currency_date, scale, amount, created, created_by, branch_id) 
-                                                    VALUES ({0}, '{1}', '{2}', '{3}', {4}, {5}, '{6}', '{7}', '{8}')
-                                                    '''.format(order_no, i.code, '810', date_str, i.scale, i.rate,
-                                                               date_now, self.login, branch))
-                self.db.sql.commit()
-                # Выводим в консоль курсы валют из таблицы
-                selects = self.db.cursor.execute(
-                    '''SELECT * FROM CURRENCY_COURSES WHERE order_no = '{0}';'''.format(order_no)).fetchall()
-                for i in self.db.select_to_value(selects):
-                    self.log.logger.info(i)
-                    sys.stdout.write(str(i) + '\n')
-                self.db.sql.commit()
-            elif len(req) == 2:
-                # Находим уже существующие коды, обновляем ордер и архив
-                codes_exist = []
-                for i in req[1]:
-                    tmp_codes_exist = self.db.cursor.execute('''SELECT currency_no_1 FROM CURRENCY_COURSES 
-                    WHERE currency_date = '{0}' AND currency_no_1 = '{1}';'''.format(date_str, str(i))).fetchone()
-                    if tmp_codes_exist is not None:
-                        codes_exist.append(tmp_codes_exist)
-                # Обновляем архив
-                self.db.cursor.execute('BEGIN TRANSACTION;')
-                for i in codes_exist:
-                    self.db.cursor.execute('''UPDATE CURRENCY_COURSES SET updated = '{0}', updated_by = '{1}' 
-                    WHERE order_no = {2} AND currency_date = '{3}' AND currency_no_1 = '{4}';
-                    '''.format(date_now, self.login, order_no, date_str, str(i[0])))
-                self.db.cursor.execute('END;')
-                self.db.sql.commit()
-
-                # Находим еще несуществующие курсы
-                codes_dont_exist = []
-                list_codes_exist = []
-                values_dont_exist = []
-                for i in range(len(codes_exist)):
-                    list_codes_exist.append(codes_exist[i][0])
-
-                for i in range(len(req[1])):
-                    if str(req[1][i]) not in list_codes_exist:
-                        codes_dont_exist.append(req[1][i])
-                for i in range(len(values)):
-                    if int(values[i].code) in codes_dont_exist:
-                        values_dont_exist.append(values[i])
+                self.db.insert_courses(order_no, date_str, [rates.get(i) for i in inserted], date_now, self.login,
+                                       branch)
+                self.log.logger.info('Распоряжение {0}: добавлено {1}, изменено {2}, без изменений {3}'.format(
+                    order_no, len(inserted), len(updated), len(unchanged)))
+        return order_no
+
+
+# Ежедневная синхронизация архива: находит пропущенные рабочие дни одним запросом
+# и загружает только их. Отметка (watermark) - день, до которого в архиве нет пропусков.
+# Повторный запуск после сбоя безопасен: уже загруженные даты не запрашиваются
+class SyncScheduler:
+    def __init__(self, user, start_date, url=DAILY_INFO_URL, workers=8, interval=3600, clock=date.today,
+                 sleep=time.sleep, name='daily'):
+        self.user = user
+        self.db = user.db
+        self.start_date = start_date
+        self.url = url
+        self.workers = workers
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self.name = name
+        # Логгирование
+        self.log = Logger()
+        with self.db.sql:
+            self.db.cursor.execute('''CREATE TABLE IF NOT EXISTS SYNC_STATE (
+            name TEXT PRIMARY KEY NOT NULL,
+            watermark TEXT NOT NULL,
+            updated TEXT DEFAULT (datetime('now', 'localtime'))
+            );''')
+
+    def get_watermark(self):
+        watermark = self.db.cursor.execute('''SELECT watermark FROM SYNC_STATE WHERE name = ?;''',
+                                           (self.name,)).fetchone()
+        return None if watermark is None else date.fromisoformat(watermark[0])
+
+    def set_watermark(self, day):
+        with self.db.sql:
+            self.db.cursor.execute('''INSERT OR REPLACE INTO SYNC_STATE (name, watermark, updated) 
+            VALUES (?, ?, datetime('now', 'localtime'));''', (self.name, day.isoformat()))
+
+    # Рабочие дни (пн-пт) диапазона, за которые в архиве нет курсов
+    def find_gaps(self, date_from, date_to):
+        return [date.fromisoformat(i[0]) for i in self.db.cursor.execute('''
+        WITH RECURSIVE days(day) AS (SELECT ? UNION ALL SELECT date(day, '+1 day') FROM days WHERE day < ?)
+        SELECT day FROM days WHERE strftime('%w', day) NOT IN ('0', '6') 
+        AND NOT EXISTS (SELECT 1 FROM CURRENCY_COURSES WHERE currency_date_iso = day);''',
+                                                                  (date_from.isoformat(), date_to.isoformat()))]
+
+    # Один проход синхронизации, возвращает число загруженных дат
+    def run_once(self):
+        today = self.clock()
+        watermark = self.get_watermark()
+        date_from = self.start_date if watermark is None else max(self.start_date, watermark + timedelta(days=1))
+        if date_from > today:
+            return 0
+        gaps = self.find_gaps(date_from, today)
+        loaded = self.user.ingest_dates([i.strftime('%d.%m.%Y') for i in gaps], (), self.url, self.workers)
+        # Отметку сдвигаем до первого незагруженного дня
+        remaining = self.find_gaps(date_from, today) if loaded < len(gaps) else []
+        watermark = (remaining[0] if len(remaining) > 0 else today + timedelta(days=1)) - timedelta(days=1)
+        if watermark >= date_from:
+            self.set_watermark(watermark)
+        self.log.logger.info('Синхронизация: пропусков {0}, загружено {1}, отметка {2}'.format(
+            len(gaps), loaded, watermark))
+        return loaded
+
+    def run(self, iterations=None):
+        n = 0
+        while iterations is None or n < iterations:
+            # Ошибка прохода не останавливает планировщик: пропуски догружаются на следующем интервале
+            try:
+                self.run_once()
+            except Exception as e:
+                self.log.logger.error('Синхронизация не выполнена: {0}'.format(e))
+            n += 1
+            if iterations is None or n < iterations:
+                self.sleep(self.interval)
+
+
+# Выгрузка архива в CSV или Parquet: курсы читаются порциями по chunk_size строк (fetchmany),
+# поэтому память не зависит от объема архива. В режиме incremental выгружаются только строки,
+# добавленные после прошлой выгрузки (отметка - последний course_id в EXPORT_STATE)
+class Exporter:
+    columns = ('course_id', 'order_no', 'currency_no_1', 'currency_no_2', 'currency_date', 'scale', 'amount',
+               'created', 'created_by', 'branch_id', 'updated', 'updated_by')
+    order_columns = ('order_created', 'order_created_by', 'order_branch_id', 'order_remarks')
+
+    def __init__(self, db=None, chunk_size=10000, name='export'):
+        self.db = DB() if db is None else db
+        self.chunk_size = chunk_size
+        self.name = name
+        # Логгирование
+        self.log = Logger()
+        with self.db.sql:
+            self.db.cursor.execute('''CREATE TABLE IF NOT EXISTS EXPORT_STATE (
+            name TEXT PRIMARY KEY NOT NULL,
+            course_id INTEGER NOT NULL,
+            updated TEXT DEFAULT (datetime('now', 'localtime'))
+            );''')
+
+    def get_watermark(self):
+        watermark = self.db.cursor.execute('''SELECT course_id FROM EXPORT_STATE WHERE name = ?;''',
+                                           (self.name,)).fetchone()
+        return 0 if watermark is None else watermark[0]
+
+    def set_watermark(self, course_id):
+        with self.db.sql:
+            self.db.cursor.execute('''INSERT OR REPLACE INTO EXPORT_STATE (name, course_id, updated) 
+            VALUES (?, ?, datetime('now', 'localtime'));''', (self.name, course_id))
+
+    def header(self, with_order=False):
+        return self.columns + (self.order_columns if with_order else ())
+
+    # Строки архива порциями (дата - в формате YYYY-MM-DD)
+    def chunks(self, date_from=None, date_to=None, codes=None, with_order=False, since=0):
+        query = '''SELECT c.course_id, c.order_no, c.currency_no_1, c.currency_no_2, c.currency_date_iso, c.scale, 
+        c.amount, c.created, c.created_by, c.branch_id, c.updated, c.updated_by'''
+        if with_order:
+            query += ''', o.created, o.created_by, o.branch_id, o.remarks FROM CURRENCY_COURSES c 
+            LEFT JOIN CURRENCY_ORDER o ON o.order_no = c.order_no'''
+        else:
+            query += ' FROM CURRENCY_COURSES c'
+        query += ' WHERE c.course_id > ?'
+        params = [since]
+        if date_from is not None:
+            query += ' AND c.currency_date_iso >= ?'
+            params.append(date_from.isoformat())
+        if date_to is not None:
+            query += ' AND c.currency_date_iso <= ?'
+            params.append(date_to.isoformat())
+        if codes is not None:
+            query += ' AND c.currency_no_1 IN ({0})'.format(', '.join('?' * len(codes)))
+            params += [str(i) for i in codes]
+        # Отдельный курсор, чтобы другие запросы не сбросили выборку
+        cursor = self.db.sql.cursor()
+        cursor.execute(query + ' ORDER BY c.course_id;', params)
+        try:
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if len(rows) == 0:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    # Выгрузка в CSV (поток) или Parquet (файл). Возвращает число строк
+    def export(self, fmt, out, date_from=None, date_to=None, codes=None, with_order=False, incremental=False):
+        since = self.get_watermark() if incremental else 0
+        chunks = self.chunks(date_from, date_to, codes, with_order, since)
+        if fmt == 'parquet':
+            rows, last = self.write_parquet(out, chunks, with_order)
+        else:
+            rows, last = self.write_csv(out, chunks, with_order)
+        if incremental and rows > 0:
+            self.set_watermark(last)
+        self.log.logger.info('Выгружено строк: {0} ({1})'.format(rows, fmt))
+        return rows
+
+    def write_csv(self, out, chunks, with_order=False):
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(self.header(with_order))
+        rows = 0
+        last = 0
+        for chunk in chunks:
+            writer.writerows(chunk)
+            rows += len(chunk)
+            last = chunk[-1][0]
+        return rows, last
+
+    def write_parquet(self, path, chunks, with_order=False):
+        if pyarrow is None:
+            raise RuntimeError('Для выгрузки в Parquet нужен пакет pyarrow')
+        types = [pyarrow.int64(), pyarrow.int64(), pyarrow.string(), pyarrow.string(), pyarrow.string(),
+                 pyarrow.int64(), pyarrow.float64()] + [pyarrow.string()] * 5
+        if with_order:
+            types += [pyarrow.string()] * 4
+        schema = pyarrow.schema(list(zip(self.header(with_order), types)))
+        rows = 0
+        last = 0
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            for chunk in chunks:
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(i, type=t) for i, t in zip(zip(*chunk), types)], schema=schema))
+                rows += len(chunk)
+                last = chunk[-1][0]
+        return rows, last
+
+
+# Коды рубля (курсы в архиве хранятся к рублю)
+RUB_CODES = (810, 643)
+
+
+# Матрица кросс-курсов за день: factors[i * n + j] - сколько единиц валюты j за единицу валюты i
+class RateMatrix:
+    __slots__ = ('codes', 'index', 'factors')
+
+    def __init__(self, rates):
+        # Курс за единицу валюты с учетом масштаба (например, 100 AMD)
+        units = [rates.rates[i] / rates.scales[i] for i in range(len(rates))]
+        self.codes = array('i', rates.codes)
+        self.index = dict(rates.index)
+        for code in RUB_CODES:
+            if code not in self.index:
+                self.index[code] = len(units)
+                self.codes.append(code)
+                units.append(1.0)
+        self.factors = array('d', [i / j for i in units for j in units])
+
+    def factor(self, code_from, code_to):
+        return self.factors[self.index[code_from] * len(self.codes) + self.index[code_to]]
 
-                # Добавляем несуществующие курсы в архив
-                self.db.cursor.execute('BEGIN TRANSACTION;')
-                for i in values_dont_exist:
-                    self.db.cursor.execute('''INSERT INTO CURRENCY_COURSES (order_no, currency_no_1, currency_no_2, 
-                    currency_date, scale, amount, created, created_by, branch_id) 
-                    VALUES ({0}, '{1}', '{2}', '{3}', {4}, {5}, '{6}', '{7}', '{8}')
-                    '''.format(order_no, i.code, '810', date_str, i.scale, i.rate, date_now, self.login, branch))
-                self.db.cursor.execute('END;')
-                self.db.sql.commit()
-
-                # Выводим в консоль курсы валют из таблицы
-                selects = []
-                for i in range(len(req[1])):
-                    tmp = self.db.cursor.execute(
-                        '''SELECT * FROM CURRENCY_COURSES WHERE order_no = {0} AND currency_no_1 = '{1}';'''.format(
-                            order_no, req[1][i])).fetchone()
-                    selects.append(tmp)
-                values = self.db.select_to_value(selects)
-                for i in values:
-                    self.log.logger.info(i)
-                    sys.stdout.write(str(i) + '\n')
+
+# Кросс-курсы и конвертация сумм по архиву CURRENCY_COURSES.
+# Матрицы курсов строятся один раз на дату и хранятся в LRU-кэше вместе с версией курсов даты
+# (число записей, последний course_id и суммы курсов): дозагруженная или исправленная дата строится заново
+class Converter:
+    def __init__(self, db=None, cache_size=64):
+        self.db = DB() if db is None else db
+        self.cache_size = cache_size
+        self.matrices = OrderedDict()
+        self.lock = threading.Lock()
+
+    def matrix(self, date_str):
+        version = self.db.cursor.execute('''SELECT COUNT(*), MAX(course_id), TOTAL(scale), TOTAL(amount) 
+        FROM CURRENCY_COURSES WHERE currency_date = ?;''', (date_str,)).fetchone()
+        with self.lock:
+            item = self.matrices.get(date_str)
+            if item is not None and item[0] == version:
+                self.matrices.move_to_end(date_str)
+                return item[1]
+        rates = DayRates(Value(code, scale, amount) for code, scale, amount in self.db.cursor.execute(
+            '''SELECT currency_no_1, scale, amount FROM CURRENCY_COURSES WHERE currency_date = ?;''', (date_str,)))
+        if len(rates) == 0:
+            raise ValueError('Курсы валют за {0} не найдены'.format(date_str))
+        matrix = RateMatrix(rates)
+        with self.lock:
+            self.matrices[date_str] = (version, matrix)
+            self.matrices.move_to_end(date_str)
+            while len(self.matrices) > self.cache_size:
+                self.matrices.popitem(last=False)
+        return matrix
+
+    # Курс: сколько единиц валюты code_to за одну единицу code_from
+    def cross_rate(self, date_str, code_from, code_to):
+        matrix = self.matrix(date_str)
+        try:
+            return matrix.factor(code_from, code_to)
+        except KeyError as e:
+            raise ValueError('Курс валюты {0} за {1} не найден'.format(e.args[0], date_str))
+
+    def convert(self, date_str, amount, code_from, code_to):
+        return amount * self.cross_rate(date_str, code_from, code_to)
+
+    # Пакетная конвертация за дату: коды - число (одна пара на все суммы) или последовательности
+    def convert_many(self, date_str, amounts, codes_from, codes_to):
+        if isinstance(codes_from, int) and isinstance(codes_to, int):
+            return array('d', map(self.cross_rate(date_str, codes_from, codes_to).__mul__, amounts))
+        matrix = self.matrix(date_str)
+        n = len(matrix.codes)
+        codes_from = [codes_from] * len(amounts) if isinstance(codes_from, int) else codes_from
+        codes_to = [codes_to] * len(amounts) if isinstance(codes_to, int) else codes_to
+        try:
+            rows = [matrix.index[i] * n for i in codes_from]
+            columns = [matrix.index[i] for i in codes_to]
+        except KeyError as e:
+            raise ValueError('Курс валюты {0} за {1} не найден'.format(e.args[0], date_str))
+        factors = matrix.factors
+        return array('d', [a * factors[i + j] for a, i, j in zip(amounts, rows, columns)])
+
+    # Конвертация строк (дата, сумма, из валюты, в валюту) с группировкой по датам
+    def convert_rows(self, rows):
+        groups = {}
+        for n, (date_str, amount, code_from, code_to) in enumerate(rows):
+            group = groups.setdefault(date_str, ([], [], [], []))
+            group[0].append(n)
+            group[1].append(amount)
+            group[2].append(code_from)
+            group[3].append(code_to)
+        result = array('d', bytes(8 * sum(len(i[0]) for i in groups.values())))
+        for date_str, (positions, amounts, codes_from, codes_to) in groups.items():
+            for n, value in zip(positions, self.convert_many(date_str, amounts, codes_from, codes_to)):
+                result[n] = value
+        return result
+
+
+# Аналитика по архиву: ряд курса валюты за диапазон дат в виде массива и расчеты по нему.
+# Таблица CURRENCY_DAILY (курс за единицу валюты на дату) необязательна: если она включена,
+# триггеры обновляют ее при каждой записи в архив и ряды читаются из нее
+class Analytics:
+    def __init__(self, db=None):
+        self.db = DB() if db is None else db
+
+    def has_daily(self):
+        return self.db.cursor.execute('''SELECT 1 FROM sqlite_master 
+        WHERE type = 'table' AND name = 'CURRENCY_DAILY';''').fetchone() is not None
+
+    # Создает таблицу дневных курсов, триггеры и заполняет ее по архиву
+    def enable_daily(self):
+        with self.db.sql:
+            self.db.cursor.execute('''CREATE TABLE IF NOT EXISTS CURRENCY_DAILY (
+            currency_no_1 TEXT NOT NULL,
+            currency_date_iso TEXT NOT NULL,
+            rate REAL NOT NULL,
+            PRIMARY KEY (currency_no_1, currency_date_iso)
+            ) WITHOUT ROWID;''')
+            for event in ('INSERT', 'UPDATE OF scale, amount'):
+                self.db.cursor.execute('''CREATE TRIGGER IF NOT EXISTS daily_{0} AFTER {1} ON CURRENCY_COURSES 
+                WHEN NEW.currency_date_iso IS NOT NULL AND NEW.scale > 0
+                BEGIN
+                   INSERT OR REPLACE INTO CURRENCY_DAILY (currency_no_1, currency_date_iso, rate) 
+                   VALUES (NEW.currency_no_1, NEW.currency_date_iso, NEW.amount * 1.0 / NEW.scale);
+                END;'''.format(event.split()[0].lower(), event))
+            self.db.cursor.execute('''INSERT OR REPLACE INTO CURRENCY_DAILY (currency_no_1, currency_date_iso, rate) 
+            SELECT currency_no_1, currency_date_iso, amount * 1.0 / scale FROM CURRENCY_COURSES 
+            WHERE currency_date_iso IS NOT NULL AND scale > 0 ORDER BY course_id;''')
+
+    # Ряд курса за единицу валюты: (даты YYYY-MM-DD, array('d') курсов)
+    def series(self, code, date_from, date_to):
+        if self.has_daily():
+            select = self.db.cursor.execute('''SELECT currency_date_iso, rate FROM CURRENCY_DAILY 
+            WHERE currency_no_1 = ? AND currency_date_iso BETWEEN ? AND ? ORDER BY currency_date_iso;''',
+                                            (str(code), date_from.isoformat(), date_to.isoformat()))
+        else:
+            select = self.db.cursor.execute('''SELECT currency_date_iso, MAX(course_id), amount * 1.0 / scale 
+            FROM CURRENCY_COURSES WHERE currency_no_1 = ? AND currency_date_iso BETWEEN ? AND ? 
+            GROUP BY currency_date_iso ORDER BY currency_date_iso;''',
+                                            (str(code), date_from.isoformat(), date_to.isoformat()))
+            select = ((i[0], i[2]) for i in select)
+        dates = []
+        rates = array('d')
+        for day, rate in select:
+            dates.append(day)
+            rates.append(rate)
+        return dates, rates
+
+    # Изменение курса к предыдущему дню
+    @staticmethod
+    def changes(rates):
+        return array('d', map(float.__sub__, rates[1:], rates[:-1]))
+
+    # Изменение курса к предыдущему дню в процентах
+    @staticmethod
+    def pct_changes(rates):
+        return array('d', [(j / i - 1) * 100 for i, j in zip(rates[:-1], rates[1:])])
+
+    # Скользящее среднее за window дней (накопленная сумма, без пересчета окна)
+    @staticmethod
+    def moving_average(rates, window):
+        if window <= 0 or len(rates) < window:
+            return array('d')
+        result = array('d', bytes(8 * (len(rates) - window + 1)))
+        total = math.fsum(rates[:window])
+        result[0] = total / window
+        for i in range(window, len(rates)):
+            total += rates[i] - rates[i - window]
+            result[i - window + 1] = total / window
+        return result
+
+    # Минимум, максимум, среднее и волатильность (ст. отклонение дневных логарифмических доходностей)
+    @staticmethod
+    def summary(rates):
+        if len(rates) == 0:
+            return {'count': 0}
+        returns = [math.log(j / i) for i, j in zip(rates[:-1], rates[1:])]
+        volatility = 0.0
+        if len(returns) > 1:
+            mean = math.fsum(returns) / len(returns)
+            volatility = math.sqrt(math.fsum((i - mean) ** 2 for i in returns) / (len(returns) - 1))
+        return {'count': len(rates), 'min': min(rates), 'max': max(rates), 'mean': math.fsum(rates) / len(rates),
+                'first': rates[0], 'last': rates[-1], 'volatility': volatility}
+
+
+# Пакетная обработка команд: все команды разбираются заранее, группируются по датам,
+# каждая дата загружается и записывается один раз, результат - JSON Lines или CSV
+class BatchRequest:
+    def __init__(self, user, out=sys.stdout, fmt='jsonl', workers=8, url=DAILY_INFO_URL, buffer_size=1000):
+        self.user = user
+        self.out = out
+        self.fmt = fmt
+        self.workers = workers
+        self.url = url
+        self.buffer_size = buffer_size
+        self.buffer = io.StringIO()
+        self.csv = csv.writer(self.buffer, lineterminator='\n')
+        self.written = 0
+        # Логгирование
+        self.log = Logger()
+
+    # Команды -> [(текст, дата, коды или None)]
+    def parse(self, lines):
+        commands = []
+        for text in lines:
+            text = text.strip()
+            if len(text) == 0 or text.lower() == 'q':
+                continue
+            req = ScriptRequest(text).parse_command()
+            if len(req) == 0:
+                commands.append((text, None, None))
+            else:
+                commands.append((text, '.'.join(req[0]), req[1] if len(req) == 2 else None))
+        return commands
+
+    # Дата -> объединение запрошенных кодов (None - нужны все курсы)
+    @staticmethod
+    def group(commands):
+        dates = {}
+        for text, date_str, codes in commands:
+            if date_str is None or (date_str in dates and dates[date_str] is None):
+                continue
+            dates[date_str] = None if codes is None else dates.get(date_str, set()) | set(codes)
+        return dates
+
+    # Загрузка дат из DailyInfo параллельно, запись в архив - в одном потоке
+    def fetch(self, dates):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(UserAuthorizator.fetch_values, date_str, codes or set(), self.url): date_str
+                       for date_str, codes in dates.items()}
+            for future in as_completed(futures):
+                # Ошибка по одной дате не прерывает пакет: за эту дату при чтении архива будут строки с ошибкой
+                date_str = futures[future]
+                try:
+                    date_str, values = future.result()
+                    if values is None:
+                        self.log.logger.warning('Курсы валют за {0} не загружены'.format(date_str))
+                        continue
+                    codes = dates[date_str]
+                    self.user.store_currency(date_str, values, None if codes is None else sorted(codes))
+                except Exception as e:
+                    self.log.logger.error('Ошибка загрузки курсов за {0}: {1}'.format(date_str, e))
+
+    def run(self, lines):
+        start = time.perf_counter()
+        commands = self.parse(lines)
+        dates = self.group(commands)
+        if isinstance(self.user, UserAuthorizator):
+            self.fetch(dates)
+        archive = {}
+        for date_str, codes in dates.items():
+            values = self.user.read_currency(date_str, None if codes is None else sorted(codes))
+            archive[date_str] = None if values is None else {i.code: i for i in values}
+
+        if self.fmt == 'csv':
+            self.csv.writerow(('command', 'date', 'code', 'scale', 'rate', 'error'))
+        for text, date_str, codes in commands:
+            rates = archive.get(date_str)
+            if rates is None:
+                self.write_error(text, date_str,
+                                 'Неизвестная комманда' if date_str is None else 'Курсы валют не найдены')
+            elif codes is None:
+                self.write(text, date_str, list(rates.values()))
+            else:
+                self.write(text, date_str, [rates[i] for i in codes if i in rates])
+        self.flush()
+
+        elapsed = time.perf_counter() - start
+        self.log.logger.info('Обработано команд: {0}, дат: {1} за {2:.2f} с'.format(
+            len(commands), len(dates), elapsed))
+
+    def write(self, text, date_str, values):
+        if self.fmt == 'csv':
+            # В CSV у каждой команды есть хотя бы одна строка
+            if len(values) == 0:
+                self.write_error(text, date_str, 'Курсы валют не найдены')
+                return
+            for i in values:
+                self.csv.writerow((text, date_str, i.code, i.scale, i.rate, ''))
+        else:
+            self.buffer.write(json.dumps({'command': text, 'date': date_str, 'rates': [
+                {'code': i.code, 'scale': i.scale, 'rate': i.rate} for i in values]}, ensure_ascii=False) + '\n')
+        self.written += 1
+        if self.written % self.buffer_size == 0:
+            self.flush()
+
+    def write_error(self, text, date_str, msg):
+        self.log.logger.info('{0}: {1}'.format(text, msg))
+        if self.fmt == 'csv':
+            self.csv.writerow((text, date_str or '', '', '', '', msg))
+        else:
+            self.buffer.write(json.dumps({'command': text, 'error': msg}, ensure_ascii=False) + '\n')
+        self.written += 1
+        if self.written % self.buffer_size == 0:
+            self.flush()
+
+    def flush(self):
+        self.out.write(self.buffer.getvalue())
+        self.out.flush()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+
+# HTTP-сервер: у каждого соединения свой поток, но запросы одновременно обрабатывают не больше workers потоков.
+# Простаивающее keep-alive соединение не занимает место обработчика. Соединение с БД запрос берет
+# из общего пула и возвращает по окончании, поэтому открытых соединений не больше workers
+class BoundedHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, workers=8):
+        super().__init__(address, handler)
+        self.workers = threading.BoundedSemaphore(workers)
+
+    def bounded(self, func):
+        with self.workers:
+            try:
+                func()
+            finally:
+                ConnectionPool.checkin_thread()
+
+
+# HTTP/JSON сервис курсов валют:
+#   POST /login {"login": ..., "password": ...} -> {"token": ...}
+#   POST /logout (заголовок Authorization: Bearer <token>)
+#   GET /rates?date=DD.MM.YYYY&codes=840,978 (заголовок Authorization: Bearer <token>)
+# Сессия истекает через session_ttl секунд без запросов
+class RateServer(BoundedHTTPServer):
+    def __init__(self, address, workers=8, session_ttl=3600):
+        super().__init__(address, RateRequestHandler, workers)
+        self.session_ttl = session_ttl
+        # token -> [Session, время истечения]
+        self.sessions = {}
+        self.lock = threading.Lock()
+        # Логгирование
+        self.log = Logger()
+
+    def open_session(self, session):
+        token = secrets.token_hex(16)
+        now = time.monotonic()
+        with self.lock:
+            # Заодно удаляем истекшие сессии
+            for i in [i for i, (item, expires) in self.sessions.items() if expires <= now]:
+                del self.sessions[i]
+            self.sessions[token] = [session, now + self.session_ttl]
+        self.log.logger.info('Открыта сессия {0}'.format(session.login))
+        return token
+
+    def get_session(self, token):
+        now = time.monotonic()
+        with self.lock:
+            item = self.sessions.get(token)
+            if item is None:
+                return None
+            if item[1] <= now:
+                del self.sessions[token]
+                return None
+            item[1] = now + self.session_ttl
+            return item[0]
+
+    def close_session(self, token):
+        with self.lock:
+            item = self.sessions.pop(token, None)
+        if item is None:
+            return False
+        self.log.logger.info('Закрыта сессия {0}'.format(item[0].login))
+        return True
+
+
+class RateRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело ответа уходят одним пакетом
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # Простаивающее keep-alive соединение закрываем, чтобы освободить поток
+    timeout = 30
+
+    def do_POST(self):
+        self.server.bounded(self.post)
+
+    def do_GET(self):
+        self.server.bounded(self.get)
+
+    def token(self):
+        return self.headers.get('Authorization', '').replace('Bearer ', '', 1)
+
+    def post(self):
+        path = urlparse(self.path).path
+        if path == '/logout':
+            if self.server.close_session(self.token()):
+                self.send_json(200, {})
+            else:
+                self.send_json(401, {'error': 'Требуется авторизация'})
+            return
+        if path != '/login':
+            self.send_json(404, {'error': 'Неизвестный адрес'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            self.send_json(400, {'error': 'Неверный формат запроса'})
+            return
+        au = Authorization()
+        au.login = str(body.get('login', ''))
+        au.password = str(body.get('password', ''))
+        if not au.is_logged_in():
+            self.send_json(401, {'error': 'Неудачная попытка авторизации'})
+            return
+        self.send_json(200, {'token': self.server.open_session(au.session)})
+
+    def get(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            self.send_body(200, Metrics.exposition().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
+            return
+        if url.path != '/rates':
+            self.send_json(404, {'error': 'Неизвестный адрес'})
+            return
+        session = self.server.get_session(self.token())
+        if session is None:
+            self.send_json(401, {'error': 'Требуется авторизация'})
+            return
+        query = parse_qs(url.query)
+        text = ' '.join(query.get('date', [''])[:1] + [i for i in ','.join(query.get('codes', [])).split(',') if i])
+        req = ScriptRequest(text).parse_command()
+        if len(req) == 0:
+            self.send_json(400, {'error': 'Неизвестная комманда'})
+            return
+        codes = req[1] if len(req) == 2 else None
+        if session.authorizator:
+            user = UserAuthorizator(session.login, session)
+            values = user.load_currency(req[0], codes)
+            # DailyInfo недоступен: отдаем курсы из архива, если они там есть
+            if values is None:
+                values = user.read_currency('.'.join(req[0]), codes)
+                if values is None:
+                    self.send_json(503, {'error': 'Сервис DailyInfo недоступен'})
+                    return
+        else:
+            values = User(session.login, session).read_currency('.'.join(req[0]), codes)
+        if values is None:
+            self.send_json(404, {'error': 'Курсы валют не найдены'})
+            return
+        self.send_json(200, {'date': '.'.join(req[0]), 'rates': [
+            {'code': i.code, 'scale': i.scale, 'rate': i.rate} for i in values]})
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Журнал запросов в stderr не пишем
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Курсы валют ЦБ РФ')
+    parser.add_argument('--log-json', action='store_true', help='писать лог в формате JSON')
+    parser.add_argument('--metrics', metavar='FILE', help='при выходе записать метрики в формате Prometheus')
+    modes = parser.add_subparsers(dest='mode')
+    batch = modes.add_parser('batch', help='пакетная обработка команд DD.MM.YYYY [codes]')
+    batch.add_argument('file', nargs='?', default='-', help='файл с командами (по умолчанию stdin)')
+    batch.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl')
+    batch.add_argument('--workers', type=int, default=8)
+    sync = modes.add_parser('sync', help='синхронизация архива с DailyInfo (нужен авторизатор)')
+    sync.add_argument('--start', required=True, help='первая дата архива DD.MM.YYYY')
+    sync.add_argument('--interval', type=int, default=3600, help='пауза между проходами, с')
+    sync.add_argument('--once', action='store_true', help='один проход и выход')
+    sync.add_argument('--workers', type=int, default=8)
+    export = modes.add_parser('export', help='выгрузка архива в CSV или Parquet')
+    export.add_argument('--format', choices=('csv', 'parquet'), default='csv')
+    export.add_argument('--out', default='-', help='файл (для CSV по умолчанию stdout)')
+    export.add_argument('--from', dest='date_from', help='с даты DD.MM.YYYY')
+    export.add_argument('--to', dest='date_to', help='по дату DD.MM.YYYY')
+    export.add_argument('--codes', help='коды валют через запятую')
+    export.add_argument('--with-order', action='store_true', help='добавить данные распоряжения')
+    export.add_argument('--incremental', action='store_true', help='только строки после прошлой выгрузки')
+    serve = modes.add_parser('serve', help='HTTP/JSON сервис курсов валют (/rates, /metrics)')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--workers', type=int, default=8)
+    return parser.parse_args()
+
+
+def export(args):
+    date_from = None if args.date_from is None else datetime.strptime(args.date_from, '%d.%m.%Y').date()
+    date_to = None if args.date_to is None else datetime.strptime(args.date_to, '%d.%m.%Y').date()
+    codes = None if args.codes is None else [int(i) for i in args.codes.split(',')]
+    exporter = Exporter()
+    if args.format == 'parquet':
+        if args.out == '-':
+            sys.stderr.write('Для Parquet укажите файл --out\n')
+            return
+        exporter.export('parquet', args.out, date_from, date_to, codes, args.with_order, args.incremental)
+    elif args.out == '-':
+        exporter.export('csv', sys.stdout, date_from, date_to, codes, args.with_order, args.incremental)
+    else:
+        with open(args.out, 'w', encoding='utf-8', newline='') as f:
+            exporter.export('csv', f, date_from, date_to, codes, args.with_order, args.incremental)
+
+
+def serve(host, port, workers):
+    server = RateServer((host, port), workers)
+    sys.stderr.write('http://{0}:{1}/\n'.format(host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
 
 
 if __name__ == '__main__':
+    args = parse_args()
+    Logger.configure(json_format=args.log_json)
+    if args.metrics:
+        atexit.register(Metrics.write, args.metrics)
     db = DB()
     db.create()
     # db.test()
-    au = Authorization()
-    login_bool = False
-    while login_bool is False:
-        au.try_logging()
-        login_bool = au.is_logged_in()
-    u = UserAuthorizator(au.login) if au.is_authorizator() is True else User(au.login)
-
-    command = ''
-    while command.lower() != 'q':
-        command = sys.stdin.readline().strip()
-        if command.lower() != 'q':
-            u.get_currency(command)
+    if args.mode == 'serve':
+        serve(args.host, args.port, args.workers)
+    else:
+        au = Authorization()
+        login_bool = False
+        while login_bool is False:
+            # В пакетном режиме и при выгрузке stdout занят результатом
+            au.try_logging(sys.stderr if args.mode in ('batch', 'export') else sys.stdout)
+            login_bool = au.is_logged_in()
+        u = UserAuthorizator(au.login, au.session) if au.is_authorizator() is True else User(au.login, au.session)
+
+        if args.mode == 'sync':
+            if isinstance(u, UserAuthorizator):
+                start_date = datetime.strptime(args.start, '%d.%m.%Y').date()
+                SyncScheduler(u, start_date, workers=args.workers, interval=args.interval).run(
+                    1 if args.once else None)
+            else:
+                sys.stderr.write('Синхронизация доступна только авторизатору\n')
+        elif args.mode == 'export':
+            export(args)
+        elif args.mode == 'batch':
+            if args.file == '-':
+                BatchRequest(u, sys.stdout, args.format, args.workers).run(sys.stdin)
+            else:
+                with open(args.file, encoding='utf-8') as f:
+                    BatchRequest(u, sys.stdout, args.format, args.workers).run(f)
+        else:
+            command = ''
+            while command.lower() != 'q':
+                command = sys.stdin.readline().strip()
+                if command.lower() != 'q':
+                    u.get_currency(command)
     db.close()